@@ -0,0 +1,273 @@
+import argparse
+import hashlib
+import io
+import logging
+import os
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from utils.beatmap_table import BeatmapTable
+from utils.leb128 import Uleb128, encode_uleb128, read_uleb128, read_uleb128_batch
+from utils.osu_db import Beatmap, lookup_beatmaps, parse_osu_db, parse_osu_db_parallel, parse_osu_db_stream
+from utils.osu_db_cache import load_osu_db_index
+from utils.primitives import osuString
+from utils.seeding import FORMULAS, eligible_players, parse_score_grid, seed_players
+
+
+def write_synthetic_osu_db(db_path, beatmap_count: int, osu_version: int = 20231016):
+    """
+    Write an osu!.db with `beatmap_count` made-up difficulties, laid out like a real one.
+    """
+    out = io.BytesIO()
+    out.write(struct.pack("<IIBQ", osu_version, beatmap_count // 5 + 1, 1, 0))
+    osuString.write_string("benchmark", out)
+    out.write(struct.pack("<I", beatmap_count))
+    for beatmap_no in range(beatmap_count):
+        set_no = beatmap_no // 5
+        md5_hash = hashlib.md5(str(beatmap_no).encode()).hexdigest()
+        for string in (f"Artist {set_no}", "", f"Title {set_no}", "", "Mapper",
+                       f"Insane {beatmap_no % 5}", "audio.mp3", md5_hash,
+                       f"Artist {set_no} - Title {set_no} (Mapper) [Insane {beatmap_no % 5}].osu"):
+            osuString.write_string(string, out)
+        out.write(struct.pack("<BHHHQffffd", 4, 400, 200, 2, 638000000000000000, 9.0, 4.0, 5.0, 8.5, 1.4))
+        for _ in range(4):
+            out.write(struct.pack("<I", 9))
+            for mods in (0, 64, 256, 16, 2, 80, 272, 66, 258):
+                out.write(struct.pack("<BIBd", 0x08, mods, 0x0d, 5.5 + mods / 1000))
+        out.write(struct.pack("<IIII", 180, 190000, 60000, 12))
+        for timing_no in range(12):
+            out.write(struct.pack("<ddB", 300.0, timing_no * 10000.0, 1))
+        out.write(struct.pack("<II", 1000000 + beatmap_no, 500000 + set_no))
+        out.write(b"\x00" * 4)  # Thread id
+        out.write(b"\x09" * 4)  # Grades
+        out.write(struct.pack("<hfB", 0, 0.7, 0))
+        osuString.write_string("Some Anime", out)
+        osuString.write_string(" ".join(f"tag{i}" for i in range(40)), out)
+        out.write(struct.pack("<h", 0))
+        osuString.write_string("", out)
+        out.write(struct.pack("<BQB", 0, 638000000000000000, 0))
+        osuString.write_string(f"{500000 + set_no} Artist {set_no} - Title {set_no}", out)
+        out.write(struct.pack("<Q", 638000000000000000))
+        out.write(b"\x00" * 5)
+        out.write(struct.pack("<IB", 0, 0))
+    out.write(struct.pack("<I", 0))  # User permissions
+    Path(db_path).write_bytes(out.getvalue())
+
+
+def timed(function, *args, repeat: int = 3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def beatmap_fields(beatmap):
+    return {name: getattr(beatmap, name) for name in Beatmap.__slots__}
+
+
+def traced_memory(function, *args):
+    tracemalloc.start()
+    result = function(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, result
+
+
+def benchmark_osu_db(db_path=None, beatmap_count: int = 20000, processes: int = None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if db_path is None:
+            db_path = Path(tmp_dir) / "osu!.db"
+            write_synthetic_osu_db(db_path, beatmap_count)
+
+        stream_time, stream_beatmaps = timed(parse_osu_db_stream, db_path)
+        buffer_time, buffer_beatmaps = timed(parse_osu_db, db_path)
+        # A lobby's worth of replays spread over the library
+        hashes = list(buffer_beatmaps)[::len(buffer_beatmaps) // 16][:16]
+        lookup_time, found = timed(lambda: list(lookup_beatmaps(db_path, hashes)))
+        parallel_time, parallel_beatmaps = timed(parse_osu_db_parallel, db_path, processes, 0)
+        parallel_lookup_time, _ = timed(lambda: [beatmaps[md5_hash] for beatmaps in
+                                                 [parse_osu_db_parallel(db_path, processes, 0)]
+                                                 for md5_hash in hashes])
+
+    assert stream_beatmaps.keys() == buffer_beatmaps.keys()
+    for md5_hash, beatmap in stream_beatmaps.items():
+        assert beatmap_fields(beatmap) == beatmap_fields(buffer_beatmaps[md5_hash]), md5_hash
+    assert [beatmap.md5_hash for beatmap in found] == hashes
+    assert list(parallel_beatmaps) == list(buffer_beatmaps)
+    for md5_hash, beatmap in parallel_beatmaps.items():
+        assert beatmap_fields(beatmap) == beatmap_fields(buffer_beatmaps[md5_hash]), md5_hash
+
+    print(f"{len(buffer_beatmaps)} beatmaps")
+    print(f"parse_osu_db_stream: {stream_time:.3f}s")
+    print(f"parse_osu_db:        {buffer_time:.3f}s ({stream_time / buffer_time:.1f}x)")
+    print(f"lookup_beatmaps x{len(hashes)}: {lookup_time:.3f}s ({stream_time / lookup_time:.1f}x)")
+    print(f"parse_osu_db_parallel ({processes or os.cpu_count()} processes): "
+          f"{parallel_time:.3f}s ({stream_time / parallel_time:.1f}x), "
+          f"{parallel_lookup_time:.3f}s with {len(hashes)} lookups")
+
+
+def benchmark_osu_db_cache(db_path=None, beatmap_count: int = 20000):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if db_path is None:
+            db_path = Path(tmp_dir) / "osu!.db"
+            write_synthetic_osu_db(db_path, beatmap_count)
+        cache_path = Path(tmp_dir) / "osu_db_index.sqlite"
+
+        cold_time, index = timed(load_osu_db_index, db_path, cache_path, repeat=1)
+        md5_hash = next(iter(index))
+        index.close()
+        warm_time, index = timed(load_osu_db_index, db_path, cache_path)
+        lookup_time, _ = timed(index.__getitem__, md5_hash)
+        print(f"{len(index)} beatmaps")
+        index.close()
+
+    print(f"Cold index build: {cold_time:.3f}s")
+    print(f"Warm index open:  {warm_time * 1000:.2f}ms")
+    print(f"Single lookup:    {lookup_time * 1000:.3f}ms")
+
+
+def benchmark_osu_db_memory(db_path=None, beatmap_count: int = 20000, processes: int = None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if db_path is None:
+            db_path = Path(tmp_dir) / "osu!.db"
+            write_synthetic_osu_db(db_path, beatmap_count)
+
+        dict_bytes, beatmaps = traced_memory(parse_osu_db, db_path)
+        table_bytes, table = traced_memory(BeatmapTable.from_osu_db, db_path)
+        serial_table_time, _ = timed(BeatmapTable.from_osu_db, db_path, repeat=1)
+        parallel_table_time, parallel_table = timed(BeatmapTable.from_osu_db, db_path, processes, 0, repeat=1)
+
+    for md5_hash, beatmap in beatmaps.items():
+        assert table[md5_hash].folder_name == beatmap.folder_name, md5_hash
+        assert table[md5_hash].od == beatmap.od, md5_hash
+        assert parallel_table[md5_hash].folder_name == beatmap.folder_name, md5_hash
+        assert parallel_table[md5_hash].star_rating(64) == table[md5_hash].star_rating(64), md5_hash
+
+    print(f"{len(table)} beatmaps")
+    print(f"dict of Beatmap: {dict_bytes / len(beatmaps):.0f} bytes/map")
+    print(f"BeatmapTable:    {table_bytes / len(table):.0f} bytes/map ({dict_bytes / table_bytes:.1f}x smaller)")
+    print(f"BeatmapTable.from_osu_db: {serial_table_time:.3f}s serial, "
+          f"{parallel_table_time:.3f}s on {processes or os.cpu_count()} processes")
+
+
+def benchmark_leb128(count: int = 100000):
+    numbers = [(i * 7919) % 70000 for i in range(count)]
+    buffer = b"".join(encode_uleb128(number) for number in numbers)
+
+    def decode_class():
+        stream = io.BytesIO(buffer)
+        return [Uleb128(0).decode_from_stream(stream, 'read', 1) for _ in range(count)]
+
+    def decode_functional():
+        values = []
+        offset = 0
+        for _ in range(count):
+            value, offset = read_uleb128(buffer, offset)
+            values.append(value)
+        return values
+
+    def decode_batch():
+        return read_uleb128_batch(buffer, 0, count)[0]
+
+    class_time, class_values = timed(decode_class)
+    functional_time, functional_values = timed(decode_functional)
+    batch_time, batch_values = timed(decode_batch)
+    assert class_values == functional_values == batch_values == numbers
+
+    print(f"{count} varints, {len(buffer)} bytes")
+    print(f"Uleb128.decode_from_stream: {class_time:.3f}s")
+    print(f"read_uleb128:               {functional_time:.3f}s ({class_time / functional_time:.1f}x)")
+    print(f"read_uleb128_batch:         {batch_time:.3f}s ({class_time / batch_time:.1f}x)")
+
+
+def synthetic_score_rows(player_count: int, map_count: int = 10, seed: int = 0):
+    """
+    Solo Placements rows: placement in column 1, name in 3 and comma formatted
+    scores every 4 columns from 9, some of them tied and some of them missing.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for player_no in range(player_count):
+        row = [""] * (9 + map_count * 4)
+        row[1] = f"#{player_no + 1}"
+        row[3] = f"Player {player_no}"
+        skill = rng.random()
+        for map_no in range(map_count):
+            score = rng.choice((0, 500000)) if rng.random() < 0.02 else int(1000000 * skill * rng.uniform(0.6, 1))
+            row[9 + map_no * 4] = f"{score:,}"
+        rows.append(row)
+    return rows
+
+
+def _python_mod_seeds(score_rows, score_indexes):
+    """
+    The per-mod seeding as the bracket automizer did it before utils.seeding.
+    """
+    mod_scores = [sum([int(scores[idx].replace(',', '')) for idx in score_indexes]) for scores in score_rows]
+    median = statistics.median(mod_scores)
+    mod_algo_result = [score / median for score in mod_scores]
+    seeding_indexes = sorted(range(len(mod_algo_result)), key=mod_algo_result.__getitem__, reverse=True)
+    return {idx: i + 1 for i, idx in enumerate(seeding_indexes)}
+
+
+def benchmark_seeding(player_count: int = 1000, map_count: int = 10):
+    score_rows = synthetic_score_rows(player_count, map_count)
+    columns = [9 + map_no * 4 for map_no in range(map_count)]
+    eligible = eligible_players([row[3] for row in score_rows], ["Player 3", "Player 50"])
+
+    python_time, python_seeds = timed(_python_mod_seeds, score_rows, columns)
+    parse_time, scores = timed(parse_score_grid, score_rows, columns)
+    total_time, total_seeds = timed(lambda: seed_players(scores.sum(axis=1, keepdims=True)))
+    assert python_seeds == dict(enumerate(total_seeds.tolist()))
+
+    print(f"{player_count} players, {map_count} maps")
+    print(f"Python median ratio of totals:  {python_time * 1000:.2f}ms")
+    print(f"parse_score_grid:               {parse_time * 1000:.2f}ms")
+    print(f"Median ratio of totals:         {total_time * 1000:.2f}ms")
+    for formula in FORMULAS:
+        formula_time, seeds = timed(seed_players, scores, formula, eligible)
+        assert sorted(seeds[eligible].tolist()) == list(range(1, int(eligible.sum()) + 1))
+        print(f"{formula + ' per map:':<32}{formula_time * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Benchmarks for the tournament scripts.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    osu_db_parser = subparsers.add_parser("osu-db", help="osu!.db parsing")
+    osu_db_parser.add_argument("--db-path", help="Real osu!.db to parse instead of a synthetic one")
+    osu_db_parser.add_argument("--count", type=int, default=20000, help="Synthetic beatmap count")
+    osu_db_parser.add_argument("--processes", type=int, help="Processes for the parallel parser, every core by default")
+    osu_db_cache_parser = subparsers.add_parser("osu-db-cache", help="Cold and warm osu!.db index cache startup")
+    osu_db_cache_parser.add_argument("--db-path", help="Real osu!.db to index instead of a synthetic one")
+    osu_db_cache_parser.add_argument("--count", type=int, default=20000, help="Synthetic beatmap count")
+    osu_db_memory_parser = subparsers.add_parser("osu-db-memory", help="Resident size of parsed osu!.db")
+    osu_db_memory_parser.add_argument("--db-path", help="Real osu!.db to load instead of a synthetic one")
+    osu_db_memory_parser.add_argument("--count", type=int, default=20000, help="Synthetic beatmap count")
+    osu_db_memory_parser.add_argument("--processes", type=int, help="Processes for the parallel load, every core by default")
+    leb128_parser = subparsers.add_parser("leb128", help="LEB128 decoding")
+    leb128_parser.add_argument("--count", type=int, default=100000, help="Number of varints")
+    seeding_parser = subparsers.add_parser("seeding", help="Qualifier seeding on synthetic scores")
+    seeding_parser.add_argument("--players", type=int, default=1000, help="Synthetic player count")
+    seeding_parser.add_argument("--maps", type=int, default=10, help="Synthetic map count")
+    args = parser.parse_args()
+
+    if args.benchmark == "osu-db":
+        benchmark_osu_db(args.db_path, args.count, args.processes)
+    elif args.benchmark == "osu-db-cache":
+        benchmark_osu_db_cache(args.db_path, args.count)
+    elif args.benchmark == "osu-db-memory":
+        benchmark_osu_db_memory(args.db_path, args.count, args.processes)
+    elif args.benchmark == "leb128":
+        benchmark_leb128(args.count)
+    elif args.benchmark == "seeding":
+        benchmark_seeding(args.players, args.maps)
@@ -1,15 +1,32 @@
+import argparse
+import csv
 import datetime
+import logging
 import math
 import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from enum import Enum
-from pathlib import WindowsPath
-from typing import List
+from pathlib import Path
+from typing import List, Union
 
+import numpy as np
 from osrparse import Replay, ReplayEventOsu, Key
-from slider import Beatmap, HitObject, Circle, Slider, Position as SliderPosition
+from slider import Beatmap, HitObject, Position as SliderPosition
 from slider.position import distance
 
-from utils.osu_db import parse_osu_db
+from utils.judgement import (AIM_MISS, HIT_100, HIT_300, HIT_50, HIT_MISS, TIMING_MISS, HitResults,
+                             JudgementContext, diff_rate, get_judgement_context, judge_hit_events)
+from utils.osr import iter_replay_events, read_osr
+from utils.osu_db_cache import DEFAULT_CACHE_PATH, load_osu_db_index
+from utils.replay_frames import HitEvents, ReplayFrames
+from utils.star_ratings import OSU
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_COLUMNS = ("replay", "player", "beatmap_hash", "mods", "count_300", "count_100", "count_50", "count_miss",
+                    "aim_misses", "timing_misses", "offset_mean", "offset_std")
 
 
 def pos_distance(pos1: SliderPosition, pos2: SliderPosition):
@@ -49,6 +66,13 @@ class HitEvent:
         self.position = position
         self.replay_event_idx = replay_event_idx
 
+    @classmethod
+    def from_columns(cls, hit_events: HitEvents, idx: int):
+        return cls(time=datetime.timedelta(milliseconds=int(hit_events.time[idx])),
+                   keys=Key(int(hit_events.keys[idx])),
+                   position=SliderPosition(float(hit_events.x[idx]), float(hit_events.y[idx])),
+                   replay_event_idx=int(hit_events.frame_idx[idx]))
+
     @classmethod
     def from_event(cls, event: ReplayEventOsu, absolute_time: datetime.timedelta, replay_event_idx: int):
         return cls(time=absolute_time,
@@ -88,122 +112,73 @@ class MissedHitEvent(SuccessfulHitEvent):
         self.verdict = verdict
 
 
-def gather_hit_events(replay: Replay) -> list[HitEvent]:
-    hit_events = []
-    prev_m1_state = 0
-    prev_m2_state = 0
-    replay_time = 0
-    for event_idx, event in enumerate(replay.replay_data):
-        replay_time += event.time_delta
-
-        replay_keys = event.keys
-        m1_state = replay_keys & 0x1
-        m2_state = replay_keys & 0x2
+def gather_hit_events(replay: Union[Replay, ReplayFrames]) -> HitEvents:
+    if isinstance(replay, Replay):
+        replay = ReplayFrames.from_replay(replay)
 
-        if m1_state > prev_m1_state or m2_state > prev_m2_state:
-            hit_events.append(HitEvent.from_event(event=event,
-                                                  absolute_time=datetime.timedelta(milliseconds=replay_time),
-                                                  replay_event_idx=event_idx))
+    return replay.key_presses()
 
-        prev_m1_state = replay_keys & 0x1
-        prev_m2_state = replay_keys & 0x2
 
-    return hit_events
-
-
-def diff_rate(diff: float, min: float, mid: float, max: float) -> float:
-    if diff > 5:
-        return mid + (max - mid) * (diff - 5) / 5
-
-    if diff < 5:
-        return mid - (mid - min) * (5 - diff) / 5
-
-    return mid
+def get_hit_result(hit_events: Union[HitEvents, List[HitEvent]], beatmap: Union[Beatmap, JudgementContext],
+                   replay: Replay):
+    if not isinstance(hit_events, HitEvents):
+        hit_events = HitEvents(time=np.array([hit_event.time // datetime.timedelta(milliseconds=1)
+                                              for hit_event in hit_events], dtype=np.int64),
+                               keys=np.array([int(hit_event.keys) for hit_event in hit_events], dtype=np.int32),
+                               x=np.array([hit_event.position.x for hit_event in hit_events], dtype=np.float64),
+                               y=np.array([hit_event.position.y for hit_event in hit_events], dtype=np.float64),
+                               frame_idx=np.array([hit_event.replay_event_idx for hit_event in hit_events],
+                                                  dtype=np.int64))
 
+    if isinstance(beatmap, JudgementContext):
+        context = beatmap
+    else:
+        context = get_judgement_context(replay.beatmap_hash, replay.mods, beatmap)
+    print("Hit Windows:")
+    print(f"300: {context.window_300}ms")
+    print(f"100: {context.window_100}ms")
+    print(f"50: {context.window_50}ms")
+    print(f"Circle Radius: {context.circle_radius}")
 
-def get_hit_result(hit_events: List[HitEvent], beatmap: Beatmap, replay: Replay):
-    next_hitobject_idx = 0
-    next_hit_event_idx = 0
+    hit_results = judge_hit_events(hit_events, context)
+    return object_hit_events_from_results(hit_results, hit_events, context)
 
-    hit_objects = beatmap.hit_objects()
 
-    mods = {"easy": replay.mods & 2 ** 1,
-            "hard_rock": replay.mods & 2 ** 4}
-    is_sv2 = replay.mods & 2 ** 29
-    od = beatmap.od(**mods)
-    cs = beatmap.cs(**mods)
-    beatmap_50_window = datetime.timedelta(milliseconds=math.floor(diff_rate(od, 200, 150, 100)))
-    beatmap_100_window = datetime.timedelta(milliseconds=math.floor(diff_rate(od, 140, 100, 60)))
-    beatmap_300_window = datetime.timedelta(milliseconds=math.floor(diff_rate(od, 80, 50, 20)))
-    circle_radius = diff_rate(cs, 54.4, 32, 9.6)
-    circle_radius = circle_radius * 1.00041
-    print("Hit Windows:")
-    print(f"300: {beatmap_300_window}")
-    print(f"100: {beatmap_100_window}")
-    print(f"50: {beatmap_50_window}")
-    print(f"Circle Radius: {circle_radius}")
+def object_hit_events_from_results(hit_results: HitResults, hit_events: HitEvents, context: JudgementContext):
+    """
+    One SuccessfulHitEvent or MissedHitEvent per hit object, for score fixing and aim correction.
+    Objects judged without a press get the object's own time and position.
+    """
     object_hit_events = []
-
-    while next_hitobject_idx < len(hit_objects) and \
-            next_hit_event_idx < len(hit_events):
-        hit_object = hit_objects[next_hitobject_idx]
-        hit_object_position = hit_object.position
-        if replay.mods & 2 ** 4:
-            hit_object_position = hit_object.position._replace(y=hit_object.position.y_max - hit_object.position.y)
-        hit_event = hit_events[next_hit_event_idx]
-        hit_time = hit_event.time
-
-        hitobject_time = hit_object.time
-        hitobject_min_time = hitobject_time - beatmap_50_window
-        hitobject_max_time = hitobject_time + beatmap_50_window
-
-        if hit_time < hitobject_min_time:
-            next_hit_event_idx += 1
-            continue
-        elif hit_time > hitobject_max_time:
-            if isinstance(hit_object, Circle):
-                next_hitobject_idx += 1
-            object_hit_event = MissedHitEvent(**vars(hit_event), hit_object=hit_object, verdict=MissVerdict.TimingMiss)
+    for object_idx, hit_object in enumerate(context.hit_objects):
+        press_idx = int(hit_results.event_idx[object_idx])
+        if press_idx >= 0:
+            hit_event = HitEvent.from_columns(hit_events, press_idx)
         else:
-            hit_grade = HitGrade.HitMiss
-            if isinstance(hit_object, Circle) or (isinstance(hit_object, Slider) and is_sv2):
-                if pos_distance(hit_event.position, hit_object_position) > circle_radius:
-                    object_hit_event = MissedHitEvent(**vars(hit_event),
-                                                      hit_object=hit_object,
-                                                      verdict=MissVerdict.AimMiss)
-                else:
-                    hit_offset = abs(hit_object.time - hit_event.time)
-                    if hit_offset < beatmap_300_window:
-                        hit_grade = HitGrade.Hit300
-                    elif hit_offset < beatmap_100_window:
-                        hit_grade = HitGrade.Hit100
-                    elif hit_offset < beatmap_50_window:
-                        hit_grade = HitGrade.Hit50
-                    else:
-                        print(f"There is an error in the code.")
-
-                    object_hit_event = SuccessfulHitEvent(**vars(hit_event),
-                                                          grade=hit_grade,
-                                                          hit_object=hit_object)
-            else:
-                if isinstance(hit_object, Slider) and \
-                        pos_distance(hit_event.position, hit_object_position) > circle_radius:
-                    object_hit_event = MissedHitEvent(**vars(hit_event),
-                                                      hit_object=hit_object,
-                                                      verdict=MissVerdict.AimMiss)
-                else:
-                    hit_grade = HitGrade.Hit300
-                    object_hit_event = SuccessfulHitEvent(**vars(hit_event),
-                                                          grade=hit_grade,
-                                                          hit_object=hit_object)
+            object_time = hit_object.time
+            if hit_results.verdict[object_idx] == MissVerdict.TimingMiss.value:
+                object_time += datetime.timedelta(milliseconds=context.window_50)
+            hit_event = HitEvent(time=object_time,
+                                 keys=Key(0),
+                                 position=SliderPosition(float(context.object_x[object_idx]),
+                                                         float(context.object_y[object_idx])),
+                                 replay_event_idx=-1)
+
+        grade = HitGrade(int(hit_results.grade[object_idx]))
+        if grade == HitGrade.HitMiss:
+            object_hit_event = MissedHitEvent(**vars(hit_event),
+                                              hit_object=hit_object,
+                                              verdict=MissVerdict(int(hit_results.verdict[object_idx])))
+        else:
+            object_hit_event = SuccessfulHitEvent(**vars(hit_event),
+                                                  grade=grade,
+                                                  hit_object=hit_object)
         object_hit_events.append(object_hit_event)
-        next_hit_event_idx += 1
-        next_hitobject_idx += 1
 
     return object_hit_events
 
 
-def correct_miss_event(hit_event: MissedHitEvent, replay: Replay, circle_radius: float):
+def correct_miss_event(hit_event: MissedHitEvent, replay: Replay, frames: ReplayFrames, circle_radius: float):
     print(f"Aim correction for {hit_event}.")
     hit_object_position = hit_event.hit_object.position
     if replay.mods & 2 ** 4:
@@ -220,24 +195,23 @@ def correct_miss_event(hit_event: MissedHitEvent, replay: Replay, circle_radius:
     brush_radius = random.randint(12, 18)
     cursor_position = hit_event.position
     pos_change = find_position_change_by_ratio(hit_object_position, cursor_position, corrected_aim_diff_ratio)
-    replay.replay_data[hit_event.replay_event_idx].x += pos_change.x
-    replay.replay_data[hit_event.replay_event_idx].y += pos_change.y
     pull_power = random.random() / 10 + 0.8
-    for i in range(1, brush_radius):
-        prev_frame_idx = hit_event.replay_event_idx - i
-        next_frame_idx = hit_event.replay_event_idx + i
-        current_pull_power = math.pow(pull_power, i * 1.2)
-        replay.replay_data[prev_frame_idx].x += pos_change.x * current_pull_power
-        replay.replay_data[next_frame_idx].x += pos_change.x * current_pull_power
-        replay.replay_data[prev_frame_idx].y += pos_change.y * current_pull_power
-        replay.replay_data[next_frame_idx].y += pos_change.y * current_pull_power
+
+    # Pull the hit frame fully and its neighbours less the further away they are
+    frame_offsets = np.arange(-(brush_radius - 1), brush_radius)
+    frame_indexes = hit_event.replay_event_idx + frame_offsets
+    in_replay = (frame_indexes >= 0) & (frame_indexes < len(frames))
+    pull = np.power(pull_power, np.abs(frame_offsets) * 1.2)
+    pull[brush_radius - 1] = 1
+    frames.x[frame_indexes[in_replay]] += pos_change.x * pull[in_replay]
+    frames.y[frame_indexes[in_replay]] += pos_change.y * pull[in_replay]
 
     replay.count_miss = max(0, replay.count_miss - 1)
     replay.count_300 += 1
     return replay
 
 
-def fix_replay_scorev2(replay: Replay, object_hit_events: List[HitEvent], beatmap: Beatmap):
+def fix_replay_scorev2(replay: Replay, object_hit_events: List[HitEvent], context: JudgementContext):
     replay_accuracy = (replay.count_300 + replay.count_100 * 100 / 300 + replay.count_50 * 50 / 300) / (
             replay.count_300 + replay.count_100 + replay.count_50 + replay.count_miss)
     accuracy_portion = 0.3
@@ -257,17 +231,15 @@ def fix_replay_scorev2(replay: Replay, object_hit_events: List[HitEvent], beatma
     if combo > max_combo:
         max_combo = combo
     total_score = 1000000 * (
-            (replay_accuracy * accuracy_portion) + (max_combo / beatmap.max_combo) * combo_portion)
+            (replay_accuracy * accuracy_portion) + (max_combo / context.max_combo) * combo_portion)
     replay.score = int(total_score)
     return max_combo, total_score
 
 
-def fix_replay_score(replay: Replay, object_hit_events: List[HitEvent], beatmap: Beatmap):
+def fix_replay_score(replay: Replay, object_hit_events: List[HitEvent], context: JudgementContext):
     score = 0
     combo = 0
     max_combo = 0
-    mods = {"easy": replay.mods & 2 ** 1,
-            "hard_rock": replay.mods & 2 ** 4}
     mod_multipliers = {2 ** 1: 0.5,  # Easy
                        2 ** 4: 1.06,  # Hard Rock
                        2 ** 3: 1.06,  # Hidden
@@ -280,13 +252,10 @@ def fix_replay_score(replay: Replay, object_hit_events: List[HitEvent], beatmap:
     for k, v in mod_multipliers.items():
         if replay.mods & k:
             mod_multiplier *= v
-    hp = beatmap.hp(**mods)
-    od = beatmap.od(**mods)
-    cs = beatmap.cs(**mods)
-    hit_objects = beatmap.hit_objects()
-    hit_object_count = len(hit_objects)
-    drain_time = (hit_objects[-1].time - hit_objects[0].time).total_seconds()
-    diff_multiplier = round(hp + cs + od + max(min(hit_object_count / drain_time * 8, 16), 0) / 38 * 5)
+    hit_object_count = len(context)
+    drain_time = context.drain_seconds
+    diff_multiplier = round(context.hp + context.cs + context.od +
+                            max(min(hit_object_count / drain_time * 8, 16), 0) / 38 * 5)
 
     for hit_event in object_hit_events:
         score += int(hit_event.grade.value * (1 + (combo * diff_multiplier * mod_multiplier / 25)))
@@ -303,48 +272,152 @@ def fix_replay_score(replay: Replay, object_hit_events: List[HitEvent], beatmap:
     return max_combo, score
 
 
-def fix_replay_combo(replay: Replay, beatmap: Beatmap):
-    replay.max_combo = beatmap.max_combo
-
-
-def add_mods(replay):
-    # Toggle mods
-    # replay.mods ^= 2 ** 6  # Double Time
-    # replay.mods ^= 2 ** 3  # Hidden
-    # replay.mods ^= 2 ** 4  # Hidden
-    return replay
-
-
-if __name__ == '__main__':
-    beatmaps = parse_osu_db("E:\\osu!\\osu!.db")
-    replays_folder = WindowsPath("replays")
-    replay_file = list(replays_folder.glob("ErAlpha_-_Kano_-_Sayounara_Hanadorobou-san_dahkjdas_Insane_2023-10-09_Osu.osr"))[0]
+def fix_replay_combo(replay: Replay, context: JudgementContext):
+    replay.max_combo = context.max_combo
+
+
+_analysis_beatmaps = None
+_analysis_songs_folder = None
+
+
+def _init_analysis_worker(db_path, cache_path, songs_folder):
+    global _analysis_beatmaps, _analysis_songs_folder
+    _analysis_beatmaps = load_osu_db_index(db_path, cache_path)
+    _analysis_songs_folder = Path(songs_folder)
+
+
+def analyse_replay(replay_file):
+    """
+    Judge one replay without touching it, returning a row of ANALYSIS_COLUMNS,
+    or None if it is not an osu! standard replay, its beatmap is not in
+    osu!.db or it could not be judged.
+    """
+    try:
+        return _analyse_replay(replay_file)
+    except Exception as e:
+        logger.error(f"Could not analyse {replay_file}, skipping: {e!r}")
+        return None
+
+
+def _analyse_replay(replay_file):
+    replay = read_osr(replay_file)
+    if replay.mode != OSU:
+        logger.info(f"{replay_file} is not an osu! standard replay, skipping.")
+        return None
+
+    beatmap_meta = _analysis_beatmaps.get(replay.beatmap_hash)
+    if beatmap_meta is None:
+        logger.warning(f"Beatmap {replay.beatmap_hash} of {replay_file} is not in osu!.db, skipping.")
+        return None
+
+    beatmap_filepath = _analysis_songs_folder / beatmap_meta.folder_name / beatmap_meta.name_of_osu_file
+    context = get_judgement_context(replay.beatmap_hash, replay.mods, beatmap_filepath)
+    frames = ReplayFrames.from_events(iter_replay_events(replay.replay_data))
+    hit_results = judge_hit_events(gather_hit_events(frames), context)
+
+    hit_offsets = hit_results.offset[(hit_results.grade != HIT_MISS) & ~np.isnan(hit_results.offset)]
+    return (str(replay_file), replay.username, replay.beatmap_hash, replay.mods,
+            hit_results.count(HIT_300), hit_results.count(HIT_100), hit_results.count(HIT_50),
+            hit_results.count(HIT_MISS),
+            int(np.count_nonzero(hit_results.verdict == AIM_MISS)),
+            int(np.count_nonzero(hit_results.verdict == TIMING_MISS)),
+            float(hit_offsets.mean()) if len(hit_offsets) else math.nan,
+            float(hit_offsets.std()) if len(hit_offsets) else math.nan)
+
+
+def analyse_replays(replay_files, db_path, songs_folder, cache_path=DEFAULT_CACHE_PATH, workers=None):
+    """
+    Judge replays across a process pool. Each worker keeps its own judgement
+    context cache, so a lobby's replays of one map prepare it once per worker.
+    """
+    # Build or validate the index once here, the workers then only open it
+    with closing(load_osu_db_index(db_path, cache_path, processes=None)):
+        pass
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_analysis_worker,
+                             initargs=(db_path, cache_path, songs_folder)) as executor:
+        rows = executor.map(analyse_replay, replay_files, chunksize=4)
+        return [row for row in rows if row is not None]
+
+
+def write_analysis(rows, output_path: Path):
+    if output_path.suffix == ".parquet":
+        try:
+            import pandas as pd
+        except ImportError:
+            raise SystemExit("Writing Parquet needs pandas and pyarrow, write a .csv instead.")
+        pd.DataFrame.from_records(rows, columns=ANALYSIS_COLUMNS).to_parquet(output_path, index=False)
+        return
+
+    with open(output_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(ANALYSIS_COLUMNS)
+        writer.writerows(rows)
+
+
+def correct_replay(replay_file: Path, beatmaps, songs_folder: Path):
     replay = Replay.from_path(replay_file)
+    frames = ReplayFrames.from_replay(replay)
     print(f"Loaded replay file: {replay_file}")
 
     beatmap_meta = beatmaps[replay.beatmap_hash]
-    beatmap_filepath = WindowsPath("E:\\osu!\\Songs") / beatmap_meta.folder_name / beatmap_meta.name_of_osu_file
-    beatmap = Beatmap.from_path(path=str(beatmap_filepath))
+    beatmap_filepath = songs_folder / beatmap_meta.folder_name / beatmap_meta.name_of_osu_file
+    context = get_judgement_context(replay.beatmap_hash, replay.mods, beatmap_filepath)
 
-    hit_events = gather_hit_events(replay)
+    hit_events = gather_hit_events(frames)
     object_hit_events = get_hit_result(hit_events=hit_events,
-                                       beatmap=beatmap,
+                                       beatmap=context,
                                        replay=replay)
 
     corrected_replay = replay
     for hit_event in object_hit_events:
         if isinstance(hit_event, MissedHitEvent) and hit_event.verdict == MissVerdict.AimMiss:
-            mods = {"easy": replay.mods & 2 ** 1,
-                    "hard_rock": replay.mods & 2 ** 4}
-            cs = beatmap.cs(**mods)
-            circle_radius = diff_rate(cs, 54.4, 32, 9.6)
-            corrected_replay = correct_miss_event(hit_event, replay, circle_radius)
+            circle_radius = diff_rate(context.cs, 54.4, 32, 9.6)
+            corrected_replay = correct_miss_event(hit_event, replay, frames, circle_radius)
 
     add_mods(replay)
     if replay.mods & 2 ** 29:
-        max_combo, score = fix_replay_scorev2(replay, object_hit_events, beatmap)
+        max_combo, score = fix_replay_scorev2(replay, object_hit_events, context)
     else:
-        max_combo, score = fix_replay_score(replay, object_hit_events, beatmap)
+        max_combo, score = fix_replay_score(replay, object_hit_events, context)
 
-    fix_replay_combo(replay, beatmap)
+    fix_replay_combo(replay, context)
+    frames.apply_to(corrected_replay)
     corrected_replay.write_path(replay_file.with_stem(replay_file.stem + "_corrected"))
+
+
+def add_mods(replay):
+    # Toggle mods
+    # replay.mods ^= 2 ** 6  # Double Time
+    # replay.mods ^= 2 ** 3  # Hidden
+    # replay.mods ^= 2 ** 4  # Hidden
+    return replay
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Judge and correct osu! standard replays.")
+    parser.add_argument("--osu-folder", type=Path, default=Path("E:\\osu!"),
+                        help="osu! install holding osu!.db and Songs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyse_parser = subparsers.add_parser("analyse", help="Write hit statistics of every replay in a folder. "
+                                                           "Replays are only read, never modified.")
+    analyse_parser.add_argument("replays_folder", type=Path)
+    analyse_parser.add_argument("--output", type=Path, default=Path("replay_analysis.csv"),
+                                help="Statistics file, .csv or .parquet (needs pandas)")
+    analyse_parser.add_argument("--workers", type=int, default=None, help="Worker processes, all cores by default")
+
+    correct_parser = subparsers.add_parser("correct", help="Fix aim misses of one replay and write it "
+                                                           "next to the original with a _corrected suffix.")
+    correct_parser.add_argument("replay_file", type=Path)
+    args = parser.parse_args()
+
+    db_path = args.osu_folder / "osu!.db"
+    songs_folder = args.osu_folder / "Songs"
+    if args.command == "analyse":
+        replay_files = sorted(args.replays_folder.glob("*.osr"))
+        rows = analyse_replays(replay_files, db_path, songs_folder, workers=args.workers)
+        write_analysis(rows, args.output)
+        logger.info(f"Wrote statistics of {len(rows)}/{len(replay_files)} replays to {args.output}.")
+    else:
+        correct_replay(args.replay_file, load_osu_db_index(db_path, processes=None), songs_folder)
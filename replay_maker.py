@@ -1,52 +1,119 @@
+import argparse
 import datetime
-import json
 import logging
 import os
-import shutil
-import subprocess
 import sys
-from operator import itemgetter
+import tempfile
+import unittest
+from array import array
 from pathlib import WindowsPath
+from types import SimpleNamespace
+from typing import List
 
-from osrparse import Replay
+import numpy as np
 from rosu_pp_py import Beatmap, Calculator
 
-from utils.osu_db import parse_osu_db
-from slider import Beatmap as SliderBeatmap
+from utils.danser_config import DanserConfigTemplate
+from utils.osr import read_osr
+from utils.osu_db_cache import load_osu_db_index
+from utils.osu_file import hit_object_time_range
+from utils.render_queue import RenderJob, RenderQueue
+from utils.strain_cache import BeatmapStrains, StrainCache
 
 
-def get_beatmap_spikes(replay, beatmaps, video_len_ms: int = 60000):
+def get_beatmap_spikes(replay, beatmaps, video_len_ms: int = 60000, strain_cache: StrainCache = None):
+    """
+    The best (begin, end) clip of `video_len_ms`. Raises ValueError when the map is shorter than the clip.
+    """
+    spikes = get_beatmap_spike_candidates(replay, beatmaps, (video_len_ms,), strain_cache=strain_cache)[video_len_ms]
+    if not spikes:
+        raise ValueError(f"Beatmap {replay.beatmap_hash} is shorter than a {video_len_ms / 1000:.0f}s clip.")
+    return spikes[0]
+
+
+def get_beatmap_spike_candidates(replay, beatmaps, video_lens_ms=(60000, 120000), top_k: int = 1,
+                                 strain_cache: StrainCache = None):
+    """
+    Up to `top_k` non-overlapping (begin, end) clips per video length, best first,
+    from a single strain calculation, taken from `strain_cache` when given.
+    """
     beatmap_hash = replay.beatmap_hash
     beatmap = beatmaps[beatmap_hash]
-    beatmap_filepath = WindowsPath("E:\\osu!\\Songs") / beatmap.folder_name / beatmap.name_of_osu_file
-    slider_beatmap = SliderBeatmap.from_path(path=str(beatmap_filepath))
+
+    def compute_strains():
+        beatmap_filepath = WindowsPath("E:\\osu!\\Songs") / beatmap.folder_name / beatmap.name_of_osu_file
+        return calculate_beatmap_strains(beatmap_filepath, replay.mods)
+
+    if strain_cache is None:
+        beatmap_strains = compute_strains()
+    else:
+        beatmap_strains = strain_cache.get_or_compute(beatmap_hash, replay.mods, compute_strains)
+    video_lengths = [video_len_ms * beatmap_strains.clock_rate for video_len_ms in video_lens_ms]
+    return get_spikes_by_continuous_max(beatmap_strains, video_lengths, top_k, keys=video_lens_ms)
+
+
+def calculate_beatmap_strains(beatmap_filepath, mods: int) -> BeatmapStrains:
+    first_object_ms, last_object_ms = hit_object_time_range(beatmap_filepath)
     map = Beatmap(path=str(beatmap_filepath))
-    calc = Calculator(mods=replay.mods)
+    calc = Calculator(mods=mods)
     strains = calc.strains(map)
     beatmap_attributes = calc.map_attributes(map)
-    video_length = video_len_ms * beatmap_attributes.clock_rate
-    spike_begin, spike_end = get_spike_by_continuous_max(slider_beatmap, strains, video_length,
-                                                         beatmap_attributes.clock_rate)
-    return spike_begin, spike_end
+    return BeatmapStrains(section_len=strains.section_len,
+                          aim=array('d', strains.aim),
+                          speed=array('d', strains.speed),
+                          clock_rate=beatmap_attributes.clock_rate,
+                          first_object_ms=first_object_ms,
+                          last_object_ms=last_object_ms)
+
 
+def ranked_strain_windows(total_strains: np.ndarray, window_len: int) -> List[int]:
+    """
+    Start sections of every window of `window_len` sections, highest strain sum first.
+    Empty if the map is shorter than the window.
+    """
+    window_count = len(total_strains) - window_len
+    if window_count <= 0:
+        return []
+    prefix_sums = np.concatenate(([0], np.cumsum(total_strains, dtype=np.float64)))
+    window_sums = prefix_sums[window_len:window_len + window_count] - prefix_sums[:window_count]
+    return np.argsort(-window_sums, kind="stable").tolist()
 
-def get_spike_by_continuous_max(beatmap, strains, video_length: int, clock_rate):
-    rolling_window_len = int(video_length / strains.section_len / clock_rate)
-    total_strains = [sum(x) for x in zip(strains.speed, strains.aim)]
 
-    first_object = beatmap.hit_objects()[0]
-    last_object = beatmap.hit_objects()[-1]
+def get_spikes_by_continuous_max(strains: BeatmapStrains, video_lengths, top_k: int = 1, keys=None):
+    """
+    Up to `top_k` non-overlapping clips for several video lengths at once, keyed by `keys`
+    (the video lengths by default). Lengths that do not fit in the map get an empty list.
 
-    beatmap_begin = first_object.time.total_seconds() * 1000 * clock_rate
-    beatmap_end = last_object.time.total_seconds() * 1000 * clock_rate
+    Everything is in map time: the hit object times, `video_lengths` (already scaled by the clock rate)
+    and the sections, which rosu-pp spaces `section_len` ms of real time apart.
+    """
+    total_strains = np.add(strains.speed, strains.aim, dtype=np.float64)
+    section_ms = strains.section_len * strains.clock_rate
+    beatmap_begin = strains.first_object_ms
+    beatmap_end = strains.last_object_ms
 
-    rolling_sum_spikes = []
-    for i in range(0, len(total_strains) - rolling_window_len):
-        rolling_sum_spikes.append(sum(total_strains[i:rolling_window_len + i]))
-    spike_index, max_spike = max(enumerate(rolling_sum_spikes), key=itemgetter(1))
-    spike_ms = beatmap_begin + int((spike_index + (rolling_window_len / 2)) * strains.section_len)
+    spikes = {}
+    for key, video_length in zip(keys or video_lengths, video_lengths):
+        rolling_window_len = int(video_length / section_ms)
+        clips = []
+        for spike_index in ranked_strain_windows(total_strains, rolling_window_len):
+            spike_ms = beatmap_begin + int((spike_index + (rolling_window_len / 2)) * section_ms)
+            clip_begin, clip_end = generate_spike_begin_end_from_max(beatmap_begin, beatmap_end, spike_ms,
+                                                                     video_length)
+            # Clamping to the map bounds can shift a clip, so compare what is actually emitted
+            if all(clip_end <= begin or end <= clip_begin for begin, end in clips):
+                clips.append((clip_begin, clip_end))
+                if len(clips) == top_k:
+                    break
+        spikes[key] = clips
+    return spikes
 
-    return generate_spike_begin_end_from_max(beatmap_begin, beatmap_end, spike_ms, video_length)
+
+def get_spike_by_continuous_max(strains: BeatmapStrains, video_length: int):
+    spikes = get_spikes_by_continuous_max(strains, [video_length])[video_length]
+    if not spikes:
+        raise ValueError(f"Beatmap is shorter than a {video_length / strains.clock_rate / 1000:.0f}s clip.")
+    return spikes[0]
 
 
 def generate_spike_begin_end_from_max(beatmap_begin, beatmap_end, spike_ms, video_length):
@@ -61,42 +128,88 @@ def generate_spike_begin_end_from_max(beatmap_begin, beatmap_end, spike_ms, vide
     return spike_begin, spike_end
 
 
-def update_danser_config(replay_mod, full_replay: bool = False):
-    with open("danser_config.json", "r") as f:
-        danser_config = json.load(f)
-
-    mod_colors = {
-        "NM": 210,
-        "HD": 45,
-        "HR": 1,
-        "DT": 258,
-        "FM": 32,
-        "TB": 334,
-    }
-    danser_config["Gameplay"]["StrainGraph"]["FgColor"]["Hue"] = mod_colors[replay_mod]
-    danser_config["Gameplay"]["StrainGraph"]["Show"] = True
-    danser_config["Gameplay"]["Mods"]["Show"] = True
-    if replay_mod == "TB":
-        danser_config["Recording"]["Filters"] = "fade=t=in:st=0:d=2.5,fade=t=out:st=117.5:d=2.5"
-        danser_config["Recording"]["AudioFilters"] = "afade=t=in:st=0:d=2.5,afade=t=out:st=117.5:d=2.5"
-    else:
-        danser_config["Recording"]["Filters"] = "fade=t=in:st=0:d=2.5,fade=t=out:st=57.5:d=2.5"
-        danser_config["Recording"]["AudioFilters"] = "afade=t=in:st=0:d=2.5,afade=t=out:st=57.5:d=2.5"
+MOD_HUES = {
+    "NM": 210,
+    "HD": 45,
+    "HR": 1,
+    "DT": 258,
+    "FM": 32,
+    "TB": 334,
+}
+
+
+def danser_config_overlay(replay_mod, full_replay: bool = False) -> dict:
+    """
+    The danser settings that differ between jobs, applied over danser_config.json.
+    """
     if full_replay:
-        danser_config["Recording"]["Filters"] = ""
-        danser_config["Recording"]["AudioFilters"] = ""
-        danser_config["Gameplay"]["StrainGraph"]["Show"] = False
-        danser_config["Gameplay"]["Mods"]["Show"] = False
+        filters = audio_filters = ""
+    elif replay_mod == "TB":
+        filters = "fade=t=in:st=0:d=2.5,fade=t=out:st=117.5:d=2.5"
+        audio_filters = "afade=t=in:st=0:d=2.5,afade=t=out:st=117.5:d=2.5"
+    else:
+        filters = "fade=t=in:st=0:d=2.5,fade=t=out:st=57.5:d=2.5"
+        audio_filters = "afade=t=in:st=0:d=2.5,afade=t=out:st=57.5:d=2.5"
+    return {"Gameplay": {"StrainGraph": {"FgColor": {"Hue": MOD_HUES[replay_mod]},
+                                         "Show": not full_replay},
+                         "Mods": {"Show": not full_replay}},
+            "Recording": {"Filters": filters,
+                          "AudioFilters": audio_filters}}
+
+
+class TestGetBeatmapSpikes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.strain_cache = StrainCache(os.path.join(self.tmp_dir.name, "strain_cache.sqlite"))
+        self.replay = SimpleNamespace(beatmap_hash="0" * 32, mods=0)
+        self.beatmaps = {self.replay.beatmap_hash: SimpleNamespace(folder_name="set", name_of_osu_file="map.osu")}
+
+    def tearDown(self):
+        self.strain_cache.close()
+        self.tmp_dir.cleanup()
 
-    with open("danser_config.json", "w") as f:
-        json.dump(danser_config, f, indent=4)
+    def put_strains(self, section_count: int, clock_rate: float = 1.0):
+        strains = array('d', (float(section % 7) for section in range(section_count)))
+        self.strain_cache.put(self.replay.beatmap_hash, self.replay.mods,
+                              BeatmapStrains(section_len=400, aim=strains, speed=strains, clock_rate=clock_rate,
+                                             first_object_ms=0, last_object_ms=section_count * 400 * clock_rate))
 
+    def assert_candidates(self, clock_rate: float):
+        self.put_strains(400, clock_rate)
+        candidates = get_beatmap_spike_candidates(self.replay, self.beatmaps, (60000,), top_k=2,
+                                                  strain_cache=self.strain_cache)[60000]
+        self.assertEqual(len(candidates), 2)
+        for spike_begin, spike_end in candidates:
+            # a 60s video of the map at `clock_rate` covers 60s * clock_rate of map time
+            self.assertEqual(spike_end - spike_begin, datetime.timedelta(seconds=60 * clock_rate))
+            self.assertLessEqual(spike_end, datetime.timedelta(milliseconds=400 * 400 * clock_rate))
+        (first_begin, first_end), (second_begin, second_end) = candidates
+        self.assertTrue(first_end <= second_begin or second_end <= first_begin)
 
-def copy_danser_config():
-    shutil.copyfile("danser_config.json", "C:\\danser\\settings\\danser_config.json")
+    def test_clip(self):
+        self.put_strains(400)
+        spike_begin, spike_end = get_beatmap_spikes(self.replay, self.beatmaps, strain_cache=self.strain_cache)
+        self.assertEqual(spike_end - spike_begin, datetime.timedelta(seconds=60))
+
+    def test_double_time_candidates(self):
+        self.assert_candidates(1.5)
+
+    def test_half_time_candidates(self):
+        self.assert_candidates(0.75)
+
+    def test_map_shorter_than_clip(self):
+        # 100 sections of 400ms is a 40s map
+        self.put_strains(100)
+        with self.assertRaises(ValueError):
+            get_beatmap_spikes(self.replay, self.beatmaps, strain_cache=self.strain_cache)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render highlight clips and full replays with danser.")
+    parser.add_argument("--danser-workers", type=int, default=2, help="danser-cli renders running at once")
+    parser.add_argument("--ffmpeg-workers", type=int, default=2, help="ffmpeg remuxes running at once")
+    args = parser.parse_args()
 
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
@@ -127,67 +240,45 @@ if __name__ == '__main__':
                     "FlasTEH": "AristiaEdit",
                     "Orkay": "Vaxei_2023"
                     }
-    args = ["danser-cli", "-noupdatecheck", "-record", "-preciseprogress"]
-    beatmaps = parse_osu_db("E:\\osu!\\osu!.db")
+    beatmaps = load_osu_db_index("E:\\osu!\\osu!.db", processes=None)
+    strain_cache = StrainCache()
+    danser_config = DanserConfigTemplate.from_path("danser_config.json")
+    jobs = []
     for replay_file in replays_folder.glob("full/*.osr"):
-        replay = Replay.from_path(replay_file)
+        replay = read_osr(replay_file)
         replay_filename = replay_file.name.replace("_", " ")
         replay_player = " ".join(replay_filename.split(" ")[:-1])
         replay_mod = replay_filename.split(" ")[-1][:2]
-        beatmap = beatmaps[replay.beatmap_hash]
-        beatmap_filepath = WindowsPath("E:\\osu!\\Songs") / beatmap.folder_name / beatmap.name_of_osu_file
-        slider_beatmap = SliderBeatmap.from_path(path=str(beatmap_filepath))
-        end_time = slider_beatmap.hit_objects()[-1].time
-
-        replay_skin = player_skins[replay_player]
-        video_path = replay_file.stem
-        update_danser_config(replay_mod, full_replay=True)
-        copy_danser_config()
-        video_length = str(end_time)
-
-        video_fullpath = WindowsPath(replay_file.with_suffix(".mp4").name)
-        extra = ["-replay", f"{replay_file}", "-skin", f"{replay_skin}", "-out", f"{video_path}",
-                 "-settings=danser_config"]
-        final_args = args + extra
-        subprocess.run(final_args)
-
-        ffmpeg_args = ["ffmpeg", "-y", "-i", f"C:\\danser\\videos\\{video_path}.mp4",
-                       "-c:v", "copy", "-c:a", "copy",
-                       "-avoid_negative_ts", "1", f"videos/{video_fullpath}"]
-        subprocess.run(ffmpeg_args)
-        os.rename(replay_file, f"replays/old/{replay_filename}")
+        jobs.append(RenderJob(replay_file=replay_file,
+                              skin=player_skins[replay_player],
+                              name=replay_file.stem,
+                              settings=danser_config.render_json(danser_config_overlay(replay_mod, full_replay=True)),
+                              output_file=WindowsPath("videos") / replay_file.with_suffix(".mp4").name,
+                              done_file=WindowsPath("replays/old") / replay_filename))
 
     for replay_file in replays_folder.glob("*.osr"):
-        replay = Replay.from_path(replay_file)
+        replay = read_osr(replay_file)
         replay_filename = replay_file.name.replace("_", " ")
         replay_player = " ".join(replay_filename.split(" ")[:-1])
         replay_mod = replay_filename.split(" ")[-1][:2]
         full_replay = False
+        spike_begin = spike_end = None
         if replay_mod == "TB":
-            video_length = "00:02:00"
-            spike_begin, spike_end = get_beatmap_spikes(replay, beatmaps, 120000)
-        else:
-            video_length = "00:01:00"
-            try:
-                spike_begin, spike_end = get_beatmap_spikes(replay, beatmaps)
-            except ValueError:
-                full_replay=True
-        replay_skin = player_skins[replay_player]
-        video_path = replay_file.stem
-        update_danser_config(replay_mod, full_replay=full_replay)
-        copy_danser_config()
-        video_fullpath = WindowsPath(replay_file.with_suffix(".mp4").name)
-        if not full_replay:
-            extra = ["-replay", f"{replay_file}", "-skin", f"{replay_skin}", "-out", f"{video_path}", "-start",
-                     f"{spike_begin.total_seconds()}", "-end", f"{spike_end.total_seconds()}", "-settings=danser_config"]
+            video_len_ms, video_length = 120000, "00:02:00"
         else:
-            extra = ["-replay", f"{replay_file}", "-skin", f"{replay_skin}", "-out", f"{video_path}", "-settings=danser_config"]
-        final_args = args + extra
-        subprocess.run(final_args)
-
-        ffmpeg_args = ["ffmpeg", "-y", "-to", video_length,
-                       "-i", f"C:\\danser\\videos\\{video_path}.mp4",
-                       "-c:v", "copy", "-c:a", "copy",
-                       "-avoid_negative_ts", "1", f"videos/{video_fullpath}"]
-        subprocess.run(ffmpeg_args)
-        os.rename(replay_file, f"replays/old/{replay_filename}")
+            video_len_ms, video_length = 60000, "00:01:00"
+        try:
+            spike_begin, spike_end = get_beatmap_spikes(replay, beatmaps, video_len_ms, strain_cache)
+        except ValueError:
+            full_replay=True
+        jobs.append(RenderJob(replay_file=replay_file,
+                              skin=player_skins[replay_player],
+                              name=replay_file.stem,
+                              settings=danser_config.render_json(danser_config_overlay(replay_mod, full_replay)),
+                              output_file=WindowsPath("videos") / replay_file.with_suffix(".mp4").name,
+                              done_file=WindowsPath("replays/old") / replay_filename,
+                              start=None if full_replay else spike_begin.total_seconds(),
+                              end=None if full_replay else spike_end.total_seconds(),
+                              length=video_length))
+
+    RenderQueue(danser_workers=args.danser_workers, ffmpeg_workers=args.ffmpeg_workers).run(jobs)
@@ -1,14 +1,33 @@
-import copy
+import argparse
 import datetime
+import hashlib
 import json
+import logging
 import shutil
-import statistics
+import sys
+import tempfile
+import time
+import unittest
 from collections import defaultdict
-from pathlib import WindowsPath
+from pathlib import Path, WindowsPath
+from typing import Dict
+from unittest import mock
 
+import httplib2
+import numpy as np
+from google.auth.exceptions import TransportError
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 
+from utils.bracket import Match, Round, RoundBeatmap, SeedingBeatmap, SeedingResult, Team
+from utils.files import write_if_changed
+from utils.seeding import MEDIAN_RATIO, eligible_players, parse_score_grid, seed_players
+from utils.sheets import (DEFAULT_SNAPSHOT_DIR, TRANSPORT_ERRORS, UNFORMATTED_VALUE, FakeSheetsService, RangeBatch,
+                          SheetSnapshotStore, SheetValues, fetch_ranges, fetch_ranges_cached)
+
+logger = logging.getLogger(__name__)
+
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', ]
 
 # The ID and range of a sample spreadsheet.
@@ -27,75 +46,56 @@ MAPPOOL_RANGE_NAMES = ['Ro32!AP3:BC',
 REFEREE_SHEET_ID = '1siLQHsD1csVQBKHaLRr4kVtdQ20TcS9lla3VeIUWX9k'
 BRACKET_RANGE_NAME = "Bracket Schedule!B2:L"
 
+STATS_BATCH = RangeBatch(STATS_SHEET_ID, [SCORES_RANGE_NAME, TEAMS_RANGE_NAME])
+MAPPOOL_BATCH = RangeBatch(MAPPOOL_SHEET_ID, MAPPOOL_RANGE_NAMES)
+REFEREE_BATCH = RangeBatch(REFEREE_SHEET_ID, [BRACKET_RANGE_NAME], UNFORMATTED_VALUE)
+SHEET_BATCHES = [STATS_BATCH, MAPPOOL_BATCH, REFEREE_BATCH]
 
-def get_player_seeds(score_rows, disqualified_players):
-    new_seedings = {}
-    seed = 1
-    for row in score_rows:
-        player = row[3]
-        player_original_seed = row[1][1:]
-        if player in disqualified_players:
-            player_seed = "DQF"
-        else:
-            player_seed = seed
-            seed += 1
-        new_seedings[player_original_seed] = player_seed
-
-    return new_seedings
-
-
-def mod_score_calculation(score_rows):
-    scores = {"NM": [9 + i * 4 for i in range(4)],
-              "HD": [25 + i * 4 for i in range(2)],
-              "HR": [33 + i * 4 for i in range(2)],
-              "DT": [41 + i * 4 for i in range(2)]}
-    mod_seeds = {"NM": [],
-                 "HD": [],
-                 "HR": [],
-                 "DT": []}
-    for mod_name, score_indexes in scores.items():
-        mod_scores = [sum([int(scores[idx].replace(',', '')) for idx in score_indexes]) for scores in score_rows]
-        median = statistics.median(mod_scores)
-        mod_algo = lambda x: x / median
-        mod_algo_result = [mod_algo(score) for score in mod_scores]
-        seeding_indexes = [i for i in
-                           sorted(range(len(mod_algo_result)), key=mod_algo_result.__getitem__, reverse=True)]
-        seedings = {idx: i + 1 for i, idx in enumerate(seeding_indexes)}
-        mod_seeds[mod_name] = seedings
+
+def fetch_bracket_sheets(sheet, http_factory=None, store: SheetSnapshotStore = None, max_age: float = 0,
+                         offline: bool = False, batches=SHEET_BATCHES) -> SheetValues:
+    if store is None:
+        return fetch_ranges(sheet, batches, http_factory)
+    return fetch_ranges_cached(sheet, batches, store, max_age, offline, http_factory)
+
+
+MOD_SCORE_COLUMNS = {"NM": [9 + i * 4 for i in range(4)],
+                     "HD": [25 + i * 4 for i in range(2)],
+                     "HR": [33 + i * 4 for i in range(2)],
+                     "DT": [41 + i * 4 for i in range(2)]}
+
+
+def get_player_seeds(score_rows, eligible: np.ndarray):
+    """
+    Rows come sorted by qualifier placement, players outside `eligible` are skipped.
+    """
+    seeds = np.cumsum(eligible).tolist()
+    return {row[1][1:]: seed if is_eligible else "DQF"
+            for row, seed, is_eligible in zip(score_rows, seeds, eligible.tolist())}
+
+
+def mod_score_calculation(score_rows, eligible: np.ndarray = None, formula: str = MEDIAN_RATIO):
+    """
+    Seed players per mod on their summed mod scores, as {row index: seed}.
+    Players outside `eligible` are left out of the statistics and get seed 0.
+    """
+    scores = parse_score_grid(score_rows, [idx for score_indexes in MOD_SCORE_COLUMNS.values()
+                                           for idx in score_indexes])
+    mod_seeds = {}
+    mod_start = 0
+    for mod_name, score_indexes in MOD_SCORE_COLUMNS.items():
+        mod_scores = scores[:, mod_start:mod_start + len(score_indexes)].sum(axis=1, keepdims=True)
+        mod_start += len(score_indexes)
+        mod_seeds[mod_name] = dict(enumerate(seed_players(mod_scores, formula, eligible).tolist()))
 
     return mod_seeds
 
 
-def update_teams(sheet, bracket_json):
-    score_url = sheet.values().get(spreadsheetId=STATS_SHEET_ID,
-                                   range=SCORES_RANGE_NAME).execute()
-    player_scores = score_url.get('values', [])
-    teams_url = sheet.values().get(spreadsheetId=STATS_SHEET_ID,
-                                   range=TEAMS_RANGE_NAME).execute()
-    player_info = teams_url.get('values', [])
+def update_teams(sheet_values: SheetValues, bracket_json):
+    player_scores = sheet_values[(STATS_SHEET_ID, SCORES_RANGE_NAME)]
+    player_info = sheet_values[(STATS_SHEET_ID, TEAMS_RANGE_NAME)]
     players_by_id = {player[1]: player[0] for player in player_info}
     teams = []
-    team_template = {
-        "FullName": "",
-        "FlagName": "",
-        "Acronym": "",
-        "Seed": "",
-        "LastYearPlacing": 0,
-        "Players": [
-        ],
-        "SeedingResults": [
-            {
-                "Beatmaps": [
-                    {
-                        "ID": 1,
-                        "Seed": 1
-                    }
-                ],
-                "Mod": "NM",
-                "Seed": 1
-            }
-        ]
-    }
     mods = {"NM": {"map_count": 4,
                    "map_idx": 0},
             "HD": {"map_count": 2,
@@ -122,27 +122,22 @@ def update_teams(sheet, bracket_json):
         "Mikasa-"
     ]
     score_rows = player_scores[7:]
-    player_seeds = get_player_seeds(score_rows, disqualified_players)
-    mod_seedings = mod_score_calculation(score_rows)
+    eligible = eligible_players([row[3] for row in score_rows], disqualified_players)
+    player_seeds = get_player_seeds(score_rows, eligible)
+    mod_seedings = mod_score_calculation(score_rows, eligible)
     for player_idx, player_row in enumerate(score_rows):
         player_name = player_row[3]
-        player_team_dict = copy.deepcopy(team_template)
-
-        player_team_dict["FullName"] = player_name
-        player_team_dict["Acronym"] = player_name[:4]
-        player_team_dict["FlagName"] = "TR"
         player_original_seed = player_row[1][1:]
-        player_team_dict["Seed"] = player_seeds[player_original_seed]
+        team = Team(full_name=player_name,
+                    acronym=player_name[:4],
+                    seed=player_seeds[player_original_seed])
 
-        seeding_results = []
         score_row = player_row[8:48]
         for mod_name, mod_details in mods.items():
             map_count = mod_details["map_count"]
             map_idx = mod_details["map_idx"]
             mod_seed = mod_seedings[mod_name][player_idx]
-            mod_pool = {"Mod": mod_name,
-                        "Seed": mod_seed,
-                        "Beatmaps": []}
+            mod_pool = SeedingResult(mod=mod_name, seed=mod_seed)
             for count in range(map_count):
                 beatmap_scores = score_row[(map_idx + count) * 4:4 * (map_idx + count + 1)]
                 beatmap_seed_str = beatmap_scores[0][1:]
@@ -151,19 +146,18 @@ def update_teams(sheet, bracket_json):
                 else:
                     beatmap_seed = int(beatmap_scores[0][1:])
                 beatmap_score = int(beatmap_scores[1].replace(',', ''))
-                mod_pool["Beatmaps"].append({"ID": beatmaps[map_idx + count],
-                                             "Score": beatmap_score,
-                                             "Seed": beatmap_seed})
+                mod_pool.beatmaps.append(SeedingBeatmap(id=beatmaps[map_idx + count],
+                                                        score=beatmap_score,
+                                                        seed=beatmap_seed))
 
-            seeding_results.append(mod_pool)
-        player_team_dict["SeedingResults"] = seeding_results
-        teams.append(player_team_dict)
+            team.seeding_results.append(mod_pool)
+        teams.append(team)
 
-    bracket_json["Teams"] = teams
+    bracket_json["Teams"] = [team.to_json() for team in teams]
     return bracket_json
 
 
-def update_mappool(sheet, bracket_json):
+def update_mappool(sheet_values: SheetValues, bracket_json):
     mappool_dict = {
         "Ro32": {"BestOf": 9,
                  "StartDate": "2023-09-23T00:00:00.0000000+03:00",
@@ -184,140 +178,321 @@ def update_mappool(sheet, bracket_json):
                "StartDate": "2023-10-28T00:00:00.0000000+03:00",
                "Description": "Grand Finals"},
     }
-    round_template = {
-        "Name": "Round of 32",
-        "Description": "",
-        "BestOf": 9,
-        "Beatmaps": [],
-        "StartDate": "2023-09-17T19:41:41.0677409+02:00",
-        "Matches": []}
     rounds = []
     for mappool_range in MAPPOOL_RANGE_NAMES:
-        result = sheet.values().get(spreadsheetId=MAPPOOL_SHEET_ID,
-                                    range=mappool_range).execute()
-        mappool = result.get('values', [])
+        mappool = sheet_values[(MAPPOOL_SHEET_ID, mappool_range)]
         beatmaps = []
         for map in mappool:
             try:
-                beatmaps.append({"ID": map[2],
-                                 "Mods": map[0]})
+                beatmaps.append(RoundBeatmap(id=map[2], mods=map[0]))
             except:
                 continue
-        round_dict = copy.deepcopy(round_template)
         mappool_name = mappool_range.split("!")[0]
         if mappool_name != "Ro32":
             continue
-        round_dict["Name"] = mappool_name
-        round_dict.update(mappool_dict[mappool_name])
-        round_dict["Beatmaps"] = beatmaps
-        rounds.append(round_dict)
+        round_details = mappool_dict[mappool_name]
+        rounds.append(Round(name=mappool_name,
+                            description=round_details["Description"],
+                            best_of=round_details["BestOf"],
+                            start_date=round_details["StartDate"],
+                            beatmaps=beatmaps))
 
-    bracket_json["Rounds"] = rounds
+    bracket_json["Rounds"] = [round.to_json() for round in rounds]
     return bracket_json
 
 
-def update_matches(sheet, bracket_json):
-    mappool_converter = {"Round of 32": "Ro32",
-                         "Round of 16": "Ro16",
-                         "Quarterfinals": "QF",
-                         "Semifinals": "SF",
-                         "Finals": "F",
-                         "Grand Finals": "GF"}
-    best_of_dict = {"Ro32": 5,
-                    "Ro16": 5,
-                    "QF": 6,
-                    "SF": 6,
-                    "F": 7,
-                    "GF": 7}
-    brackets_url = sheet.values().get(spreadsheetId=REFEREE_SHEET_ID,
-                                      range=BRACKET_RANGE_NAME,
-                                      valueRenderOption="UNFORMATTED_VALUE").execute()
-    matches = brackets_url.get('values', [])
-
-    match_template = {
-        "ID": 1,
-        "Team1Acronym": "Zybit",
-        "Team1Score": None,
-        "Team2Acronym": "-Satella-",
-        "Team2Score": None,
-        "Completed": False,
-        "Losers": False,
-        "PicksBans": [],
-        "Current": False,
-        "Date": "2023-09-22T23:00:00+02:00",
-        "ConditionalMatches": [],
-        "Position": {
-            "X": 670,
-            "Y": 420
-        },
-        "Acronyms": [
-            "Zybit",
-            "-Satella-"
-        ],
-        "WinnerColour": "Blue",
-        "PointsToWin": 5
-    }
-    x = 0
-    y = 0
+MAPPOOL_CONVERTER = {"Round of 32": "Ro32",
+                     "Round of 16": "Ro16",
+                     "Quarterfinals": "QF",
+                     "Semifinals": "SF",
+                     "Finals": "F",
+                     "Grand Finals": "GF"}
+BEST_OF_DICT = {"Ro32": 5,
+                "Ro16": 5,
+                "QF": 6,
+                "SF": 6,
+                "F": 7,
+                "GF": 7}
+# Match fields filled from the referee sheet, the rest belong to the tournament client
+MATCH_SHEET_KEYS = ("ID", "Team1Acronym", "Team1Score", "Team2Acronym", "Team2Score", "Completed", "Date",
+                    "Acronyms", "PointsToWin")
+
+
+def match_from_row(row, x: int, y: int) -> Match:
+    match_player1 = row[6]
+    match_player2 = row[7]
+    match_date = datetime.date(year=1900, month=1, day=1) + datetime.timedelta(days=row[2] - 2)
+    match_total_minutes = row[3] * 24 * 60
+    match_hours = int(match_total_minutes // 60)
+    match_minutes = int(match_total_minutes % 60)
+    match_datetime = datetime.datetime(year=match_date.year,
+                                       month=match_date.month,
+                                       day=match_date.day,
+                                       hour=match_hours,
+                                       minute=match_minutes)
+    match_mappool = MAPPOOL_CONVERTER[row[0]]
+    match = Match(id=row[1],
+                  team1_acronym=match_player1[:4],
+                  team2_acronym=match_player2[:4],
+                  date=match_datetime.strftime("%Y-%m-%dT%H:%M:%S+03:00"),
+                  acronyms=[match_player1, match_player2],
+                  points_to_win=BEST_OF_DICT[match_mappool],
+                  x=x,
+                  y=y)
+    if len(row) > 8:
+        match.team1_score = row[8] if row[8] != "FF" else -1
+        match.team2_score = row[9] if row[9] != "FF" else -1
+        match.completed = True
+    return match
+
+
+def schedule_rows(sheet_values: SheetValues):
+    return [row for row in sheet_values[(REFEREE_SHEET_ID, BRACKET_RANGE_NAME)] if len(row) >= 6]
+
+
+def update_round_matches(rows, bracket_json):
     round_matches = defaultdict(list)
-    matches_array = []
-    for row in matches:
-        match_dict = copy.deepcopy(match_template)
-        if len(row) < 6:
-            continue
-        match_id = row[1]
-        match_player1 = row[6]
-        match_player2 = row[7]
-        match_date = datetime.date(year=1900, month=1, day=1) + datetime.timedelta(days=row[2] - 2)
-        match_total_minutes = row[3] * 24 * 60
-        match_hours = int(match_total_minutes // 60)
-        match_minutes = int(match_total_minutes % 60)
-        match_datetime = datetime.datetime(year=match_date.year,
-                                           month=match_date.month,
-                                           day=match_date.day,
-                                           hour=match_hours,
-                                           minute=match_minutes)
-        match_mappool = mappool_converter[row[0]]
-        best_of = best_of_dict[match_mappool]
-        acronyms = [match_player1, match_player2]
-        if len(row) > 8:
-            match_dict["Team1Score"] = row[8] if row[8] != "FF" else -1
-            match_dict["Team2Score"] = row[9] if row[9] != "FF" else -1
-            match_dict["Completed"] = True
-        match_dict["ID"] = match_id
-        match_dict["Team1Acronym"] = match_player1[:4]
-        match_dict["Team2Acronym"] = match_player2[:4]
-        match_dict["Date"] = match_datetime.strftime("%Y-%m-%dT%H:%M:%S+03:00")
-        match_dict["PointsToWin"] = best_of
-        match_dict["Acronyms"] = acronyms
-        match_dict["Position"]["X"] = x
-        match_dict["Position"]["Y"] = y
-        y += 120
-
-        round_matches[row[0]].append(match_id)
-        matches_array.append(match_dict)
-    bracket_json["Matches"] = matches_array
+    for row in rows:
+        round_matches[row[0]].append(row[1])
     for round in bracket_json["Rounds"]:
         if round["Name"] in round_matches.keys():
             round["Matches"] = round_matches[round["Name"]]
 
+
+def update_matches(sheet_values: SheetValues, bracket_json):
+    rows = schedule_rows(sheet_values)
+    bracket_json["Matches"] = [match_from_row(row, 0, row_idx * 120).to_json() for row_idx, row in enumerate(rows)]
+    update_round_matches(rows, bracket_json)
     return bracket_json
 
 
+# The sheets each update step reads, so a run only fetches what its steps need
+UPDATE_BATCHES = {update_teams: [STATS_BATCH],
+                  update_mappool: [MAPPOOL_BATCH],
+                  update_matches: [REFEREE_BATCH]}
+
+
+def row_hash(row) -> str:
+    return hashlib.sha1(json.dumps(row, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def sync_matches(sheet_values: SheetValues, bracket_json, row_hashes: Dict[object, str]) -> bool:
+    """
+    Update the matches whose schedule row changed since the last call, keeping
+    what the tournament client added to them (picks, bans, position...).
+    `row_hashes` carries the match id -> row hash state between calls.
+    Returns whether bracket_json changed.
+    """
+    rows = schedule_rows(sheet_values)
+    matches_by_id = {match["ID"]: match for match in bracket_json.setdefault("Matches", [])}
+    changed = False
+    for row_idx, row in enumerate(rows):
+        match_id = row[1]
+        current_hash = row_hash(row)
+        if row_hashes.get(match_id) == current_hash:
+            continue
+        row_hashes[match_id] = current_hash
+
+        new_match = match_from_row(row, 0, row_idx * 120).to_json()
+        match = matches_by_id.get(match_id)
+        if match is None:
+            logger.info(f"New match {match_id}.")
+            bracket_json["Matches"].append(new_match)
+            matches_by_id[match_id] = new_match
+            changed = True
+            continue
+        for key in MATCH_SHEET_KEYS:
+            if match.get(key) != new_match[key]:
+                logger.info(f"Match {match_id} {key}: {match.get(key)} -> {new_match[key]}.")
+                match[key] = new_match[key]
+                changed = True
+
+    rounds_before = [round.get("Matches") for round in bracket_json.get("Rounds", [])]
+    update_round_matches(rows, bracket_json)
+    return changed or rounds_before != [round.get("Matches") for round in bracket_json.get("Rounds", [])]
+
+
+def dump_bracket_json(bracket_json) -> bytes:
+    return json.dumps(bracket_json, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def watch_matches(sheet, bracket_json_path: Path, interval: float, http_factory=None,
+                  store: SheetSnapshotStore = None):
+    """
+    Poll the referee sheet every `interval` seconds and rewrite bracket.json
+    only when a match actually changed. Polls are snapshotted to `store` if given.
+    bracket.json is read again whenever it changed on disk since the last
+    read or write, so what the tournament client saves in between is kept.
+    """
+    referee_batch = UPDATE_BATCHES[update_matches]
+    bracket_json = None
+    loaded_version = None  # (mtime, size) of bracket.json as last read or written
+    row_hashes = {}
+    while True:
+        try:
+            if store is None:
+                sheet_values = fetch_ranges(sheet, referee_batch, http_factory)
+            else:
+                sheet_values = fetch_ranges_cached(sheet, referee_batch, store, http_factory=http_factory)
+        except TRANSPORT_ERRORS as e:
+            logger.warning(f"Fetching the referee sheet failed, retrying next poll: {e}")
+        else:
+            stat = bracket_json_path.stat()
+            if (stat.st_mtime_ns, stat.st_size) != loaded_version:
+                if loaded_version is not None:
+                    logger.info(f"{bracket_json_path} changed on disk, reloading it.")
+                with open(bracket_json_path, "r", encoding="utf-8") as f:
+                    bracket_json = json.load(f)
+                loaded_version = (stat.st_mtime_ns, stat.st_size)
+                # Apply every row again over the reloaded matches, only differing keys are touched
+                row_hashes.clear()
+            if sync_matches(sheet_values, bracket_json, row_hashes):
+                write_if_changed(bracket_json_path, dump_bracket_json(bracket_json))
+                stat = bracket_json_path.stat()
+                loaded_version = (stat.st_mtime_ns, stat.st_size)
+                logger.info(f"Updated {bracket_json_path}.")
+        time.sleep(interval)
+
+
+class TestModScoreCalculation(unittest.TestCase):
+
+    def score_row(self, player_name: str, score: int):
+        row = [""] * 46
+        row[1] = f"#{player_name}"
+        row[3] = player_name
+        for score_indexes in MOD_SCORE_COLUMNS.values():
+            for idx in score_indexes:
+                row[idx] = f"{score:,}"
+        return row
+
+    def test_disqualified_player(self):
+        score_rows = [self.score_row("dq", 900000), self.score_row("a", 500000), self.score_row("b", 700000)]
+        eligible = eligible_players([row[3] for row in score_rows], ["dq"])
+        self.assertEqual(get_player_seeds(score_rows, eligible), {"dq": "DQF", "a": 1, "b": 2})
+        for mod_seeds in mod_score_calculation(score_rows, eligible).values():
+            self.assertEqual(mod_seeds, {0: 0, 1: 2, 2: 1})
+
+
+class _StopWatching(Exception):
+    pass
+
+
+class TestSyncMatches(unittest.TestCase):
+    rows = [["Round of 32", 1, 45292, 0.75, "", "", "PlayerOne", "PlayerTwo"],
+            ["Round of 32", 2, 45292, 0.8125, "", "", "PlayerThree", "PlayerFour"]]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bracket_json_path = Path(self.tmp_dir.name) / "bracket.json"
+        self.empty_bracket = dump_bracket_json({"Rounds": [{"Name": "Round of 32", "Matches": []}], "Matches": []})
+        self.bracket_json_path.write_bytes(self.empty_bracket)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def sheet_values(self, rows):
+        return {(REFEREE_SHEET_ID, BRACKET_RANGE_NAME): rows}
+
+    def watch(self, between_polls, service: FakeSheetsService = None):
+        """
+        Run watch_matches over the canned rows, calling each of `between_polls` in place of the sleep.
+        """
+        service = service or FakeSheetsService(self.sheet_values(self.rows))
+        polls = iter(between_polls)
+
+        def sleep(interval):
+            between_poll = next(polls, None)
+            if between_poll is None:
+                raise _StopWatching
+            between_poll()
+
+        with mock.patch("time.sleep", sleep), self.assertRaises(_StopWatching):
+            watch_matches(service, self.bracket_json_path, interval=0)
+        with open(self.bracket_json_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_only_changed_rows_update(self):
+        bracket_json = json.loads(self.empty_bracket)
+        row_hashes = {}
+        self.assertTrue(sync_matches(self.sheet_values(self.rows), bracket_json, row_hashes))
+        self.assertEqual(bracket_json["Rounds"][0]["Matches"], [1, 2])
+        self.assertFalse(sync_matches(self.sheet_values(self.rows), bracket_json, row_hashes))
+
+        bracket_json["Matches"][0]["PicksBans"] = [{"BeatmapID": 1}]
+        rescheduled_rows = [self.rows[0][:3] + [0.875] + self.rows[0][4:], self.rows[1]]
+        self.assertTrue(sync_matches(self.sheet_values(rescheduled_rows), bracket_json, row_hashes))
+        self.assertTrue(bracket_json["Matches"][0]["Date"].endswith("21:00:00+03:00"))
+        self.assertEqual(bracket_json["Matches"][0]["PicksBans"], [{"BeatmapID": 1}])
+
+    def test_watch_keeps_client_changes(self):
+        def save_picks():
+            with open(self.bracket_json_path, "r", encoding="utf-8") as f:
+                bracket_json = json.load(f)
+            bracket_json["Matches"][1]["PicksBans"] = [{"BeatmapID": 1}]
+            self.bracket_json_path.write_bytes(dump_bracket_json(bracket_json))
+
+        bracket_json = self.watch([save_picks])
+        self.assertEqual([match["ID"] for match in bracket_json["Matches"]], [1, 2])
+        self.assertEqual(bracket_json["Matches"][1]["PicksBans"], [{"BeatmapID": 1}])
+
+    def test_watch_rewrites_external_revert(self):
+        # bracket.json going back to its old contents must still get the matches written again
+        bracket_json = self.watch([lambda: self.bracket_json_path.write_bytes(self.empty_bracket)])
+        self.assertEqual([match["ID"] for match in bracket_json["Matches"]], [1, 2])
+
+    def test_watch_survives_token_refresh_error(self):
+        service = FakeSheetsService(self.sheet_values(self.rows), error=TransportError("Token refresh failed"))
+
+        def recover():
+            service.error = None
+
+        bracket_json = self.watch([recover], service)
+        self.assertEqual(len(service.requests), 2)
+        self.assertEqual([match["ID"] for match in bracket_json["Matches"]], [1, 2])
+
+
 if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Fill the tournament client's bracket.json from the sheets.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep polling the referee sheet and update matches as they change")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between polls in watch mode")
+    parser.add_argument("--offline", action="store_true",
+                        help="Build bracket.json from the latest sheet snapshots without touching Sheets")
+    parser.add_argument("--max-age", type=float, default=0,
+                        help="Use snapshots younger than this many seconds instead of fetching")
+    parser.add_argument("--snapshot-dir", type=Path, default=DEFAULT_SNAPSHOT_DIR,
+                        help="Where sheet snapshots are kept")
+    args = parser.parse_args()
+    if args.watch and args.offline:
+        parser.error("--watch polls Sheets and cannot run --offline")
+
     bracket_json_path = WindowsPath.home() / "AppData" / "Roaming" / "osu" / "tournaments" / "default" / "bracket.json"
 
     shutil.copyfile(bracket_json_path, bracket_json_path.with_name("bracket_old.json"))
-    with open(bracket_json_path, "r", encoding="utf-8") as f:
-        bracket_json = json.load(f)
 
-    creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    service = build('sheets', 'v4', credentials=creds)
-    sheet = service.spreadsheets()
+    store = SheetSnapshotStore(args.snapshot_dir)
+    sheet = http_factory = None
+    if not args.offline:
+        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        service = build('sheets', 'v4', credentials=creds)
+        sheet = service.spreadsheets()
+        http_factory = lambda: AuthorizedHttp(creds, http=httplib2.Http())
+
+    if args.watch:
+        watch_matches(sheet, bracket_json_path, args.interval, http_factory, store)
+    else:
+        with open(bracket_json_path, "r", encoding="utf-8") as f:
+            bracket_json = json.load(f)
+        update_steps = [
+            # update_teams,
+            # update_mappool,
+            update_matches,
+        ]
+        batches = [batch for update_step in update_steps for batch in UPDATE_BATCHES[update_step]]
+        sheet_values = fetch_bracket_sheets(sheet, http_factory, store, args.max_age, args.offline, batches)
 
-    # bracket_json = update_teams(sheet, bracket_json)
-    # bracket_json = update_mappool(sheet, bracket_json)
-    bracket_json = update_matches(sheet, bracket_json)
+        for update_step in update_steps:
+            bracket_json = update_step(sheet_values, bracket_json)
 
-    with open(bracket_json_path, "w", encoding="utf-8") as f:
-        json.dump(bracket_json, f, indent=2, ensure_ascii=False)
+        write_if_changed(bracket_json_path, dump_bracket_json(bracket_json))
@@ -0,0 +1,36 @@
+import argparse
+import logging
+import sys
+
+from utils.osu_db_records import write_collection_db, write_trimmed_osu_db
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Write an osu!.db holding only the mappool beatmaps, "
+                                                 "for render boxes and the tournament client.")
+    parser.add_argument("src", help="Full osu!.db")
+    parser.add_argument("dst", help="Trimmed osu!.db to write")
+    parser.add_argument("--ids", nargs="*", type=int, default=[], help="Beatmap (difficulty) ids to keep")
+    parser.add_argument("--hashes", nargs="*", default=[], help="Beatmap md5 hashes to keep")
+    parser.add_argument("--collection-db", help="Also write a collection.db with the kept maps to this path")
+    parser.add_argument("--collection-name", default="Mappool", help="Name of that collection")
+    args = parser.parse_args()
+
+    beatmap_ids = set(args.ids)
+    md5_hashes = set(args.hashes)
+    kept = write_trimmed_osu_db(args.src, args.dst,
+                                lambda record: record.beatmap_id in beatmap_ids or record.md5_hash in md5_hashes)
+
+    missing_ids = beatmap_ids - {record.beatmap_id for record in kept}
+    if missing_ids:
+        logging.warning(f"Beatmap ids not found in {args.src}: {sorted(missing_ids)}")
+    missing_hashes = md5_hashes - {record.md5_hash for record in kept}
+    if missing_hashes:
+        logging.warning(f"Beatmap hashes not found in {args.src}: {sorted(missing_hashes)}")
+
+    if args.collection_db:
+        with open(args.dst, 'rb') as f:
+            osu_version = int.from_bytes(f.read(4), byteorder="little")
+        with open(args.collection_db, 'wb') as f:
+            write_collection_db(f, osu_version, {args.collection_name: [record.md5_hash for record in kept]})
+        logging.info(f"Wrote collection {args.collection_name} to {args.collection_db}.")
@@ -0,0 +1,194 @@
+import logging
+from array import array
+from collections.abc import Mapping
+from typing import Iterable, Tuple
+
+from utils.osu_db import PARALLEL_MIN_BEATMAPS, iter_osu_db, iter_record_chunk, map_record_chunks
+from utils.star_ratings import COMMON_MODS, common_star_rating
+
+logger = logging.getLogger(__name__)
+
+FLOAT_COLUMNS = ("ar", "cs", "hp", "od")
+DOUBLE_COLUMNS = ("sv",)
+INT_COLUMNS = ("ranked_status", "hc", "slider", "spinner", "drain_time", "total_time", "preview_time",
+               "beatmap_id", "beatmapset_id")
+STRING_COLUMNS = ("artist_name", "artist_unicode", "title", "title_unicode", "creator", "difficulty",
+                  "audio_file", "name_of_osu_file", "folder_name")
+
+_DIGEST_SIZE = 16
+
+
+class BeatmapRow:
+    """
+    Lightweight view of one row of a BeatmapTable, read like a Beatmap.
+    """
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: "BeatmapTable", row: int):
+        self.table = table
+        self.row = row
+
+    def __getattr__(self, name):
+        # Only reached for unset slots while copying or unpickling, and for dunder probes
+        if name in BeatmapRow.__slots__ or name.startswith("__"):
+            raise AttributeError(name)
+        return self.table.value(self.row, name)
+
+    def star_rating(self, mods: int = 0):
+        return self.table.star_rating(self.row, mods)
+
+    def __repr__(self):
+        return f"BeatmapRow({self.md5_hash}, {self.folder_name}/{self.name_of_osu_file})"
+
+
+class BeatmapTable(Mapping):
+    """
+    Columnar md5 -> BeatmapRow store for osu!.db.
+
+    Numeric fields live in parallel typed arrays. Text fields are indexes into
+    one packed UTF-8 string table where every distinct string is stored once,
+    so sets sharing an artist, title, creator or folder pay for it a single time.
+    Hashes are kept as raw 16-byte digests, sorted for binary search lookups.
+    osu! standard star ratings are kept for the COMMON_MODS combinations.
+    """
+
+    def __init__(self):
+        self.columns = {name: array('f') for name in FLOAT_COLUMNS}
+        self.columns.update({name: array('d') for name in DOUBLE_COLUMNS})
+        self.columns.update({name: array('I') for name in INT_COLUMNS + STRING_COLUMNS})
+        self.digests = bytearray()  # md5 digests in row order
+        self.string_data = bytearray()
+        self.string_offsets = array('I', [0])
+        self.star_ratings = array('f')  # len(COMMON_MODS) per row
+        self._sorted_digests = b""
+        self._sorted_rows = array('I')
+        self._unique_count = 0
+
+    @classmethod
+    def from_beatmaps(cls, beatmaps: Iterable, build_index: bool = True):
+        table = cls()
+        string_ids = {}
+        for beatmap in beatmaps:
+            try:
+                digest = bytes.fromhex(beatmap.md5_hash)
+            except ValueError:
+                digest = b""
+            if len(digest) != _DIGEST_SIZE:
+                logger.warning(f"Beatmap {beatmap.name_of_osu_file} has an invalid md5 hash {beatmap.md5_hash!r}.")
+                digest = bytes(_DIGEST_SIZE)
+            table.digests += digest
+            for name in FLOAT_COLUMNS + DOUBLE_COLUMNS + INT_COLUMNS:
+                table.columns[name].append(getattr(beatmap, name))
+            for name in STRING_COLUMNS:
+                string = getattr(beatmap, name)
+                string_id = string_ids.get(string)
+                if string_id is None:
+                    string_id = len(string_ids)
+                    string_ids[string] = string_id
+                    table.string_data += string.encode("utf-8")
+                    table.string_offsets.append(len(table.string_data))
+                table.columns[name].append(string_id)
+            table.star_ratings.extend(beatmap.star_ratings.common())
+
+        if build_index:
+            table._build_index()
+        return table
+
+    @classmethod
+    def from_osu_db(cls, db_path, processes: int = 1, min_beatmaps: int = PARALLEL_MIN_BEATMAPS):
+        """
+        Load osu!.db into a table. With `processes` other than 1 (None for every core), large
+        databases are split into record chunks that pool workers turn into tables of their own.
+        Those tables are only arrays and bytes, so they are cheap to send back and concatenate.
+        """
+        tables = map_record_chunks(db_path, _table_from_chunk, processes, min_beatmaps)
+        if tables is not None:
+            return cls.concat(tables)
+        return cls.from_beatmaps(iter_osu_db(db_path))
+
+    @classmethod
+    def concat(cls, tables: Iterable["BeatmapTable"]):
+        """
+        Join tables row-wise. Strings are only deduplicated within each source table.
+        """
+        table = cls()
+        for part in tables:
+            string_id_shift = len(table.string_offsets) - 1
+            string_offset_shift = len(table.string_data)
+            table.digests += part.digests
+            table.star_ratings.extend(part.star_ratings)
+            table.string_data += part.string_data
+            table.string_offsets.extend(offset + string_offset_shift for offset in part.string_offsets[1:])
+            for name, column in part.columns.items():
+                if name in STRING_COLUMNS:
+                    table.columns[name].extend(string_id + string_id_shift for string_id in column)
+                else:
+                    table.columns[name].extend(column)
+        table._build_index()
+        return table
+
+    def _build_index(self):
+        digests = self.digests
+        rows = sorted(range(len(digests) // _DIGEST_SIZE),
+                      key=lambda row: digests[row * _DIGEST_SIZE:(row + 1) * _DIGEST_SIZE])
+        self._sorted_rows = array('I', rows)
+        self._sorted_digests = b"".join(digests[row * _DIGEST_SIZE:(row + 1) * _DIGEST_SIZE] for row in rows)
+        self._unique_count = len({self._sorted_digests[i:i + _DIGEST_SIZE]
+                                  for i in range(0, len(self._sorted_digests), _DIGEST_SIZE)})
+
+    def find_row(self, md5_hash: str) -> int:
+        """
+        Row of `md5_hash`, or -1. Like a dict, the last duplicate record wins.
+        """
+        try:
+            digest = bytes.fromhex(md5_hash)
+        except ValueError:
+            return -1
+        sorted_digests = self._sorted_digests
+        low = 0
+        high = len(self._sorted_rows)
+        while low < high:
+            middle = (low + high) // 2
+            if digest < sorted_digests[middle * _DIGEST_SIZE:(middle + 1) * _DIGEST_SIZE]:
+                high = middle
+            else:
+                low = middle + 1
+        if low and sorted_digests[(low - 1) * _DIGEST_SIZE:low * _DIGEST_SIZE] == digest:
+            return self._sorted_rows[low - 1]
+        return -1
+
+    def value(self, row: int, name: str):
+        if name == "md5_hash":
+            return self.digests[row * _DIGEST_SIZE:(row + 1) * _DIGEST_SIZE].hex()
+        column = self.columns.get(name)
+        if column is None:
+            raise AttributeError(name)
+        if name in STRING_COLUMNS:
+            string_id = column[row]
+            return self.string_data[self.string_offsets[string_id]:self.string_offsets[string_id + 1]].decode()
+        return column[row]
+
+    def star_rating(self, row: int, mods: int = 0):
+        return common_star_rating(self.star_ratings, mods, row * len(COMMON_MODS))
+
+    def __getitem__(self, md5_hash):
+        row = self.find_row(md5_hash)
+        if row < 0:
+            raise KeyError(md5_hash)
+        return BeatmapRow(self, row)
+
+    def __iter__(self):
+        for row in range(len(self.digests) // _DIGEST_SIZE):
+            md5_hash = self.value(row, "md5_hash")
+            if self.find_row(md5_hash) == row:
+                yield md5_hash
+
+    def __len__(self):
+        return self._unique_count
+
+    def __contains__(self, md5_hash):
+        return self.find_row(md5_hash) >= 0
+
+
+def _table_from_chunk(chunk: Tuple[str, int, int]) -> BeatmapTable:
+    return BeatmapTable.from_beatmaps(iter_record_chunk(chunk), build_index=False)
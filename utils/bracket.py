@@ -0,0 +1,112 @@
+"""
+Typed models of the tournament client's bracket.json sections.
+
+`to_json` emits the same keys, in the same order, as the client writes, so
+bracket.json is built straight from the models without template copies.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional, Union
+
+
+@dataclass(slots=True)
+class SeedingBeatmap:
+    id: str
+    score: int
+    seed: int
+
+    def to_json(self) -> dict:
+        return {"ID": self.id, "Score": self.score, "Seed": self.seed}
+
+
+@dataclass(slots=True)
+class SeedingResult:
+    mod: str
+    seed: int
+    beatmaps: List[SeedingBeatmap] = field(default_factory=list)
+
+    def to_json(self) -> dict:
+        return {"Mod": self.mod, "Seed": self.seed, "Beatmaps": [beatmap.to_json() for beatmap in self.beatmaps]}
+
+
+@dataclass(slots=True)
+class Team:
+    full_name: str
+    acronym: str
+    seed: Union[int, str]
+    flag_name: str = "TR"
+    last_year_placing: int = 0
+    players: list = field(default_factory=list)
+    seeding_results: List[SeedingResult] = field(default_factory=list)
+
+    def to_json(self) -> dict:
+        return {"FullName": self.full_name,
+                "FlagName": self.flag_name,
+                "Acronym": self.acronym,
+                "Seed": self.seed,
+                "LastYearPlacing": self.last_year_placing,
+                "Players": self.players,
+                "SeedingResults": [seeding_result.to_json() for seeding_result in self.seeding_results]}
+
+
+@dataclass(slots=True)
+class RoundBeatmap:
+    id: str
+    mods: str
+
+    def to_json(self) -> dict:
+        return {"ID": self.id, "Mods": self.mods}
+
+
+@dataclass(slots=True)
+class Round:
+    name: str
+    description: str
+    best_of: int
+    start_date: str
+    beatmaps: List[RoundBeatmap] = field(default_factory=list)
+    matches: list = field(default_factory=list)
+
+    def to_json(self) -> dict:
+        return {"Name": self.name,
+                "Description": self.description,
+                "BestOf": self.best_of,
+                "Beatmaps": [beatmap.to_json() for beatmap in self.beatmaps],
+                "StartDate": self.start_date,
+                "Matches": self.matches}
+
+
+@dataclass(slots=True)
+class Match:
+    id: int
+    team1_acronym: str
+    team2_acronym: str
+    date: str
+    acronyms: List[str]
+    points_to_win: int
+    team1_score: Optional[int] = None
+    team2_score: Optional[int] = None
+    completed: bool = False
+    losers: bool = False
+    picks_bans: list = field(default_factory=list)
+    current: bool = False
+    conditional_matches: list = field(default_factory=list)
+    x: int = 0
+    y: int = 0
+    winner_colour: str = "Blue"
+
+    def to_json(self) -> dict:
+        return {"ID": self.id,
+                "Team1Acronym": self.team1_acronym,
+                "Team1Score": self.team1_score,
+                "Team2Acronym": self.team2_acronym,
+                "Team2Score": self.team2_score,
+                "Completed": self.completed,
+                "Losers": self.losers,
+                "PicksBans": self.picks_bans,
+                "Current": self.current,
+                "Date": self.date,
+                "ConditionalMatches": self.conditional_matches,
+                "Position": {"X": self.x, "Y": self.y},
+                "Acronyms": self.acronyms,
+                "WinnerColour": self.winner_colour,
+                "PointsToWin": self.points_to_win}
@@ -0,0 +1,38 @@
+"""
+danser settings built from one parsed template and small per-job overlays.
+"""
+import json
+
+
+def apply_overlay(base: dict, overlay: dict) -> dict:
+    """
+    `base` with the nested keys of `overlay` replaced. Only the dicts on an
+    overlay path are copied, every other branch is shared with `base`.
+    """
+    merged = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = apply_overlay(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class DanserConfigTemplate:
+    """
+    The base danser_config.json, parsed once and rendered with overlays.
+    """
+
+    def __init__(self, base: dict):
+        self.base = base
+
+    @classmethod
+    def from_path(cls, path="danser_config.json"):
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def render(self, overlay: dict) -> dict:
+        return apply_overlay(self.base, overlay)
+
+    def render_json(self, overlay: dict) -> bytes:
+        return json.dumps(self.render(overlay), indent=4).encode("utf-8")
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Union
+
+
+def write_atomic(path: Union[str, os.PathLike], content: bytes):
+    """
+    Replace `path` with `content` through a temporary file in the same folder,
+    so readers never see a partially written file.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_if_changed(path: Union[str, os.PathLike], content: bytes) -> bool:
+    """
+    Atomically replace `path` with `content` unless it already holds exactly
+    that. The file is read every time, as other programs may write it too.
+    Returns whether the file was written.
+    """
+    path = Path(path)
+    try:
+        with open(path, "rb") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    write_atomic(path, content)
+    return True
+
+
+class TestWriteIfChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "bracket.json"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_is_not_written(self):
+        self.assertTrue(write_if_changed(self.path, b"A"))
+        self.assertFalse(write_if_changed(self.path, b"A"))
+
+    def test_external_write_is_overwritten(self):
+        write_if_changed(self.path, b"A")
+        self.path.write_bytes(b"B")
+        self.assertTrue(write_if_changed(self.path, b"A"))
+        self.assertEqual(self.path.read_bytes(), b"A")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,345 @@
+"""
+Array based hit judgement for osu! standard replays.
+
+Hit object times and positions are laid out as arrays once per beatmap and
+mod set, and the objects whose windows are open at each press are found
+with `searchsorted` instead of stepping through timedelta comparisons.
+"""
+import datetime
+import math
+import os
+import unittest
+from collections import OrderedDict
+from typing import Union
+
+import numpy as np
+from slider import Beatmap, Slider, Spinner
+
+from utils.replay_frames import HitEvents
+
+EASY = 2 ** 1
+HARD_ROCK = 2 ** 4
+SCORE_V2 = 2 ** 29
+# Mods that change windows, radius, positions or slider head grading
+JUDGEMENT_MODS = EASY | HARD_ROCK | SCORE_V2
+
+CIRCLE, SLIDER, SPINNER = range(3)
+
+# Same values as replay_editor's HitGrade and MissVerdict
+HIT_300, HIT_100, HIT_50, HIT_MISS = 300, 100, 50, 0
+NO_VERDICT, AIM_MISS, TIMING_MISS = -1, 0, 1
+
+PLAYFIELD_HEIGHT = 384
+
+
+def diff_rate(diff: float, min: float, mid: float, max: float) -> float:
+    if diff > 5:
+        return mid + (max - mid) * (diff - 5) / 5
+
+    if diff < 5:
+        return mid - (mid - min) * (5 - diff) / 5
+
+    return mid
+
+
+class JudgementContext:
+    """
+    Everything needed to judge and score presses on one beatmap with one
+    mod set: hit windows, circle radius, the hit objects as arrays with
+    positions already flipped for Hard Rock, and the beatmap's max combo.
+    """
+
+    def __init__(self, beatmap: Beatmap, mods: int):
+        self.mods = mods
+        self.is_sv2 = bool(mods & SCORE_V2)
+        difficulty_mods = {"easy": bool(mods & EASY),
+                           "hard_rock": bool(mods & HARD_ROCK)}
+        self.hp = beatmap.hp(**difficulty_mods)
+        self.od = beatmap.od(**difficulty_mods)
+        self.cs = beatmap.cs(**difficulty_mods)
+        self.max_combo = beatmap.max_combo
+        self.window_50 = math.floor(diff_rate(self.od, 200, 150, 100))
+        self.window_100 = math.floor(diff_rate(self.od, 140, 100, 60))
+        self.window_300 = math.floor(diff_rate(self.od, 80, 50, 20))
+        self.circle_radius = diff_rate(self.cs, 54.4, 32, 9.6) * 1.00041
+
+        self.hit_objects = beatmap.hit_objects()
+        self.object_time = np.array([hit_object.time // datetime.timedelta(milliseconds=1)
+                                     for hit_object in self.hit_objects], dtype=np.int64)
+        self.object_x = np.array([hit_object.position.x for hit_object in self.hit_objects], dtype=np.float64)
+        self.object_y = np.array([hit_object.position.y for hit_object in self.hit_objects], dtype=np.float64)
+        if mods & HARD_ROCK:
+            self.object_y = PLAYFIELD_HEIGHT - self.object_y
+        self.object_kind = np.array([SPINNER if isinstance(hit_object, Spinner) else
+                                     SLIDER if isinstance(hit_object, Slider) else CIRCLE
+                                     for hit_object in self.hit_objects], dtype=np.int8)
+
+    @property
+    def drain_seconds(self) -> float:
+        return (self.hit_objects[-1].time - self.hit_objects[0].time).total_seconds()
+
+    def __len__(self):
+        return len(self.hit_objects)
+
+
+class JudgementContextCache:
+    """
+    Bounded LRU of JudgementContexts keyed on (beatmap md5, judgement mods),
+    so every replay of a pool map shares one parsed and prepared beatmap.
+    Parsed beatmaps are kept too, for the same map played with other mods.
+    """
+
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self.contexts = OrderedDict()
+        self.beatmaps = OrderedDict()
+
+    @staticmethod
+    def _lookup(cache: OrderedDict, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _store(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def get(self, beatmap_md5: str, mods: int, beatmap: Union[Beatmap, str, os.PathLike]) -> JudgementContext:
+        """
+        `beatmap` is only read on a cache miss, as a parsed Beatmap or a path to its .osu file.
+        """
+        key = (beatmap_md5, mods & JUDGEMENT_MODS)
+        context = self._lookup(self.contexts, key)
+        if context is None:
+            if not isinstance(beatmap, Beatmap):
+                parsed_beatmap = self._lookup(self.beatmaps, beatmap_md5)
+                if parsed_beatmap is None:
+                    parsed_beatmap = Beatmap.from_path(str(beatmap))
+                    self._store(self.beatmaps, beatmap_md5, parsed_beatmap)
+                beatmap = parsed_beatmap
+            context = JudgementContext(beatmap, key[1])
+            self._store(self.contexts, key, context)
+        return context
+
+    def clear(self):
+        self.contexts.clear()
+        self.beatmaps.clear()
+
+
+judgement_contexts = JudgementContextCache()
+
+
+def get_judgement_context(beatmap_md5: str, mods: int, beatmap: Union[Beatmap, str, os.PathLike]):
+    return judgement_contexts.get(beatmap_md5, mods, beatmap)
+
+
+class HitResults:
+    """
+    Per hit object judgement: grade, signed press offset in milliseconds
+    (NaN when no press judged the object), index of the judging press in
+    the HitEvents (-1 if none) and the miss verdict.
+    """
+    __slots__ = ("grade", "offset", "event_idx", "verdict")
+
+    def __init__(self, grade: np.ndarray, offset: np.ndarray, event_idx: np.ndarray, verdict: np.ndarray):
+        self.grade = grade
+        self.offset = offset
+        self.event_idx = event_idx
+        self.verdict = verdict
+
+    def count(self, grade: int) -> int:
+        return int(np.count_nonzero(self.grade == grade))
+
+    def __len__(self):
+        return len(self.grade)
+
+
+def judge_hit_events(hit_events: HitEvents, context: JudgementContext) -> HitResults:
+    """
+    Judge every hit object of `context` against the replay's presses.
+
+    Presses are taken in order. A press hits the first unjudged object inside
+    whose circle and 50 window it lands, and is used once. Notelock holds: a
+    press cannot hit an object while an earlier object is unjudged and the
+    press comes before that object's start time. Hitting an object misses
+    every unjudged object before it. A missed object is an aim miss if a press
+    that hit nothing landed in its window, and a timing miss otherwise. Slider
+    heads only need to be hit to count as 300 unless ScoreV2 is on, and
+    spinners are not judged on presses and count as 300.
+    """
+    object_count = len(context)
+    grade = np.full(object_count, HIT_MISS, dtype=np.int16)
+    offset = np.full(object_count, np.nan)
+    event_idx = np.full(object_count, -1, dtype=np.int64)
+    verdict = np.full(object_count, NO_VERDICT, dtype=np.int8)
+    grade[context.object_kind == SPINNER] = HIT_300
+
+    window_50 = context.window_50
+    window_100 = context.window_100
+    window_300 = context.window_300
+    # Objects before alive_from have had their 50 window close, objects from open_until on have not opened it
+    alive_from = np.searchsorted(context.object_time + window_50, hit_events.time, side="left").tolist()
+    open_until = np.searchsorted(context.object_time - window_50, hit_events.time, side="right").tolist()
+
+    press_times = hit_events.time.tolist()
+    press_x = hit_events.x.tolist()
+    press_y = hit_events.y.tolist()
+    object_times = context.object_time.tolist()
+    object_x = context.object_x.tolist()
+    object_y = context.object_y.tolist()
+    object_kinds = context.object_kind.tolist()
+    squared_radius = context.circle_radius ** 2
+    grade_heads = context.is_sv2
+    aim_press = [-1] * object_count  # First press that hit nothing inside each object's window
+
+    current = 0  # Every object before it is judged
+    for press_idx, press_time in enumerate(press_times):
+        current = max(current, alive_from[press_idx])
+        x = press_x[press_idx]
+        y = press_y[press_idx]
+        hit_idx = -1
+        blocked = False
+        for object_idx in range(current, open_until[press_idx]):
+            if object_kinds[object_idx] == SPINNER:
+                continue
+            if (object_x[object_idx] - x) ** 2 + (object_y[object_idx] - y) ** 2 <= squared_radius:
+                if not blocked:
+                    hit_idx = object_idx
+                break
+            if press_time < object_times[object_idx]:
+                blocked = True
+
+        if hit_idx < 0:
+            for object_idx in range(current, open_until[press_idx]):
+                if object_kinds[object_idx] != SPINNER:
+                    if aim_press[object_idx] < 0:
+                        aim_press[object_idx] = press_idx
+                    break
+            continue
+
+        hit_offset = press_time - object_times[hit_idx]
+        event_idx[hit_idx] = press_idx
+        offset[hit_idx] = hit_offset
+        current = hit_idx + 1
+        if object_kinds[hit_idx] == SLIDER and not grade_heads:
+            grade[hit_idx] = HIT_300
+        elif abs(hit_offset) < window_300:
+            grade[hit_idx] = HIT_300
+        elif abs(hit_offset) < window_100:
+            grade[hit_idx] = HIT_100
+        else:
+            grade[hit_idx] = HIT_50
+
+    for object_idx in np.flatnonzero(grade == HIT_MISS).tolist():
+        press_idx = aim_press[object_idx]
+        if press_idx < 0:
+            verdict[object_idx] = TIMING_MISS
+        else:
+            verdict[object_idx] = AIM_MISS
+            event_idx[object_idx] = press_idx
+            offset[object_idx] = press_times[press_idx] - object_times[object_idx]
+
+    return HitResults(grade=grade, offset=offset, event_idx=event_idx, verdict=verdict)
+
+
+def _test_context(object_times, object_positions, object_kinds=None, od: float = 8, cs: float = 4,
+                  mods: int = 0) -> JudgementContext:
+    """
+    A JudgementContext built from bare arrays instead of a parsed Beatmap.
+    """
+    context = JudgementContext.__new__(JudgementContext)
+    context.mods = mods
+    context.is_sv2 = bool(mods & SCORE_V2)
+    context.od = od
+    context.cs = cs
+    context.window_50 = math.floor(diff_rate(od, 200, 150, 100))
+    context.window_100 = math.floor(diff_rate(od, 140, 100, 60))
+    context.window_300 = math.floor(diff_rate(od, 80, 50, 20))
+    context.circle_radius = diff_rate(cs, 54.4, 32, 9.6) * 1.00041
+    context.hit_objects = list(object_times)
+    context.object_time = np.array(object_times, dtype=np.int64)
+    context.object_x = np.array([x for x, _ in object_positions], dtype=np.float64)
+    context.object_y = np.array([y for _, y in object_positions], dtype=np.float64)
+    context.object_kind = np.array(object_kinds or [CIRCLE] * len(object_times), dtype=np.int8)
+    return context
+
+
+def _test_presses(presses) -> HitEvents:
+    return HitEvents(time=np.array([time for time, _, _ in presses], dtype=np.int64),
+                     keys=np.ones(len(presses), dtype=np.int64),
+                     x=np.array([x for _, x, _ in presses], dtype=np.float64),
+                     y=np.array([y for _, _, y in presses], dtype=np.float64),
+                     frame_idx=np.arange(len(presses)))
+
+
+class TestJudgeHitEvents(unittest.TestCase):
+    """
+    OD8 windows are 120/76/32 ms, and a 1/4 stream at 180 BPM is 83 ms apart
+    """
+
+    def setUp(self):
+        self.stream_times = [1000 + 83 * note for note in range(6)]
+        self.stream_positions = [(100 + 40 * note, 200) for note in range(6)]
+        self.stream = _test_context(self.stream_times, self.stream_positions)
+
+    def test_full_stream(self):
+        presses = [(time, x, y) for time, (x, y) in zip(self.stream_times, self.stream_positions)]
+        results = judge_hit_events(_test_presses(presses), self.stream)
+        self.assertEqual(results.grade.tolist(), [HIT_300] * 6)
+        self.assertEqual(results.event_idx.tolist(), list(range(6)))
+
+    def test_stream_aim_miss(self):
+        # The first press lands off every circle, the rest hit their notes on time
+        presses = [(self.stream_times[0], 100, 300)]
+        presses += [(time, x, y) for time, (x, y) in zip(self.stream_times[1:], self.stream_positions[1:])]
+        results = judge_hit_events(_test_presses(presses), self.stream)
+        self.assertEqual(results.grade.tolist(), [HIT_MISS] + [HIT_300] * 5)
+        self.assertEqual(results.verdict.tolist(), [AIM_MISS] + [NO_VERDICT] * 5)
+        self.assertEqual(results.event_idx.tolist(), list(range(6)))
+
+    def test_notelock(self):
+        # Pressing the second note before the first one's start time does nothing
+        presses = [(self.stream_times[0] - 30, *self.stream_positions[1]),
+                   (self.stream_times[0], *self.stream_positions[0]),
+                   (self.stream_times[1], *self.stream_positions[1])]
+        results = judge_hit_events(_test_presses(presses), _test_context(self.stream_times[:2],
+                                                                         self.stream_positions[:2]))
+        self.assertEqual(results.grade.tolist(), [HIT_300, HIT_300])
+        self.assertEqual(results.event_idx.tolist(), [1, 2])
+
+    def test_timing_miss(self):
+        presses = [(time, x, y) for time, (x, y) in zip(self.stream_times[2:], self.stream_positions[2:])]
+        results = judge_hit_events(_test_presses(presses), self.stream)
+        self.assertEqual(results.grade.tolist(), [HIT_MISS] * 2 + [HIT_300] * 4)
+        self.assertEqual(results.verdict.tolist(), [TIMING_MISS] * 2 + [NO_VERDICT] * 4)
+        self.assertEqual(results.event_idx.tolist(), [-1, -1, 0, 1, 2, 3])
+
+    def test_late_press(self):
+        # A late press on the first note still hits it, and the next press takes the next note
+        presses = [(self.stream_times[0] + 90, *self.stream_positions[0]),
+                   (self.stream_times[1] + 40, *self.stream_positions[1])]
+        results = judge_hit_events(_test_presses(presses), _test_context(self.stream_times[:2],
+                                                                         self.stream_positions[:2]))
+        self.assertEqual(results.grade.tolist(), [HIT_50, HIT_100])
+        self.assertEqual(results.offset.tolist(), [90, 40])
+
+    def test_slider_head(self):
+        presses = [(1070, 100, 200)]
+        slider = _test_context([1000], [(100, 200)], [SLIDER])
+        self.assertEqual(judge_hit_events(_test_presses(presses), slider).grade.tolist(), [HIT_300])
+        slider_v2 = _test_context([1000], [(100, 200)], [SLIDER], mods=SCORE_V2)
+        self.assertEqual(judge_hit_events(_test_presses(presses), slider_v2).grade.tolist(), [HIT_100])
+
+    def test_spinner(self):
+        # Spinners take no press and do not notelock the circle after them
+        context = _test_context([1000, 1050], [(256, 192), (100, 200)], [SPINNER, CIRCLE])
+        results = judge_hit_events(_test_presses([(1000, 256, 192), (1050, 100, 200)]), context)
+        self.assertEqual(results.grade.tolist(), [HIT_300, HIT_300])
+        self.assertEqual(results.event_idx.tolist(), [-1, 1])
+        self.assertEqual(results.verdict.tolist(), [NO_VERDICT, NO_VERDICT])
+
+
+if __name__ == "__main__":
+    unittest.main()
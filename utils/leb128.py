@@ -2,6 +2,7 @@
     uleb/leb python implimintation - tutorial:
         - https://en.wikipedia.org/wiki/LEB128
 """
+import io
 import unittest
 from itertools import count
 from itertools import chain
@@ -170,6 +171,129 @@ class Sleb128(BaseLEB128):
         super().__init__(base_byte_number)
 
 
+def read_uleb128(buffer, offset=0):
+    """
+    Decode an unsigned LEB128 number at `offset` of a bytes-like buffer.
+    Returns the number and the offset of the byte after it.
+    """
+    out = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        out |= (byte & 127) << shift
+        if byte < 128:
+            return out, offset
+        shift += 7
+
+
+def read_sleb128(buffer, offset=0):
+    """
+    Decode a signed LEB128 number at `offset` of a bytes-like buffer.
+    Returns the number and the offset of the byte after it.
+    """
+    out = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        out |= (byte & 127) << shift
+        shift += 7
+        if byte < 128:
+            if byte & 64:
+                out -= 1 << shift
+            return out, offset
+
+
+def read_uleb128_batch(buffer, offset=0, count=None):
+    """
+    Decode `count` consecutive unsigned LEB128 numbers, or all of them up to the end of the buffer.
+    Returns the list of numbers and the offset after the last one.
+    """
+    end = len(buffer)
+    if count is None:
+        limit = end - offset  # Every number takes at least one byte
+    else:
+        limit = count
+        # Runs of single byte numbers are their own values
+        chunk = bytes(buffer[offset:offset + count])
+        if len(chunk) == count and (not chunk or max(chunk) < 128):
+            return list(chunk), offset + count
+
+    values = []
+    append = values.append
+    while len(values) < limit and offset < end:
+        byte = buffer[offset]
+        offset += 1
+        if byte < 128:
+            append(byte)
+            continue
+        out = byte & 127
+        shift = 7
+        while True:
+            byte = buffer[offset]
+            offset += 1
+            out |= (byte & 127) << shift
+            if byte < 128:
+                break
+            shift += 7
+        append(out)
+
+    if count is not None and len(values) < count:
+        msg = 'Buffer ended after {} of {} numbers'.format(len(values), count)
+        raise IndexError(msg)
+    return values, offset
+
+
+def read_uleb128_stream(stream):
+    """
+    Decode an unsigned LEB128 number from a binary stream with a read method.
+    """
+    out = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            raise EOFError('Stream ended inside a LEB128 number')
+        byte = byte[0]
+        out |= (byte & 127) << shift
+        if byte < 128:
+            return out
+        shift += 7
+
+
+def encode_uleb128(number):
+    """
+    Shortest unsigned LEB128 encoding of a non-negative integer.
+    """
+    if number < 0:
+        msg = 'Number to encode should be non-negative'
+        raise ValueError(msg)
+    out = bytearray()
+    while True:
+        byte = number & 127
+        number >>= 7
+        if number:
+            out.append(byte | 128)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_sleb128(number):
+    """
+    Shortest signed LEB128 encoding of an integer.
+    """
+    out = bytearray()
+    while True:
+        byte = number & 127
+        number >>= 7
+        if (number == 0 and not byte & 64) or (number == -1 and byte & 64):
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 128)
+
+
 class TestUleb128EncodeDecode(unittest.TestCase):
     """
     Try etalon from - https://en.wikipedia.org/wiki/LEB128
@@ -232,5 +356,49 @@ class TestSleb128EncodeDecode(unittest.TestCase):
             self.stream, '__next__'))
 
 
+class TestFunctionalLeb128(unittest.TestCase):
+    """
+    Functional codec against the same etalons as the class based one
+    """
+
+    def test_uleb128(self):
+        self.assertEqual(b'\xe5\x8e&', encode_uleb128(624485))
+        self.assertEqual((624485, 3), read_uleb128(b'\xe5\x8e&'))
+
+    def test_sleb128(self):
+        self.assertEqual(b'\x9b\xf1Y', encode_sleb128(-624485))
+        self.assertEqual((-624485, 3), read_sleb128(b'\x9b\xf1Y'))
+
+    def test_matches_class_codec(self):
+        for number in (0, 1, 63, 64, 127, 128, 300, 16383, 16384, 2 ** 32 + 5):
+            encoded = encode_uleb128(number)
+            self.assertEqual(number, Uleb128(len(encoded)).decode(encoded))
+            self.assertEqual((number, len(encoded)), read_uleb128(encoded))
+            for signed in (number, -number):
+                encoded = encode_sleb128(signed)
+                self.assertEqual(signed, Sleb128(len(encoded)).decode(encoded))
+                self.assertEqual((signed, len(encoded)), read_sleb128(encoded))
+
+    def test_offsets(self):
+        buffer = b'\x00\xe5\x8e&\x7f'
+        self.assertEqual((624485, 4), read_uleb128(buffer, 1))
+        self.assertEqual((127, 5), read_uleb128(buffer, 4))
+
+    def test_batch(self):
+        numbers = [5, 624485, 0, 128, 127, 2 ** 40]
+        buffer = b'\xff' + b''.join(encode_uleb128(number) for number in numbers)
+        self.assertEqual((numbers, len(buffer)), read_uleb128_batch(buffer, 1))
+        self.assertEqual((numbers[:2], 5), read_uleb128_batch(buffer, 1, 2))
+        self.assertEqual(([1, 2, 3], 3), read_uleb128_batch(b'\x01\x02\x03'))
+        with self.assertRaises(IndexError):
+            read_uleb128_batch(b'\x01\x02', count=3)
+
+    def test_stream(self):
+        stream = io.BytesIO(b'\xe5\x8e&')
+        self.assertEqual(624485, read_uleb128_stream(stream))
+        with self.assertRaises(EOFError):
+            read_uleb128_stream(stream)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
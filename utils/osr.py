@@ -0,0 +1,111 @@
+"""
+Header-only .osr reader.
+
+osrparse's Replay.from_path decompresses and parses every frame of a replay.
+Scripts that only need the beatmap hash, player or mods read the header here
+instead, and the LZMA frame payload stays a view into the file's bytes until
+`iter_replay_events` streams it.
+"""
+import datetime
+import lzma
+import struct
+from typing import Iterator, NamedTuple
+
+from osrparse import Key, ReplayEventOsu
+
+from utils.primitives import read_string
+
+_MODE_VERSION = struct.Struct("<Bi")
+_REPLAY_COUNTS = struct.Struct("<hhhhhhih?i")  # 300, 100, 50, geki, katu, miss, score, max combo, perfect, mods
+_TIMESTAMP_LENGTH = struct.Struct("<qi")  # Windows ticks, length of the LZMA payload
+_REPLAY_ID = struct.Struct("<q")
+_OLD_REPLAY_ID = struct.Struct("<i")
+
+RNG_SEED_FRAME = -12345
+_RNG_SEED_PREFIX = b"%d|" % RNG_SEED_FRAME
+WINDOWS_EPOCH = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+
+class OsrHeader(NamedTuple):
+    mode: int
+    game_version: int
+    beatmap_hash: str
+    username: str
+    replay_hash: str
+    count_300: int
+    count_100: int
+    count_50: int
+    count_geki: int
+    count_katu: int
+    count_miss: int
+    score: int
+    max_combo: int
+    perfect: bool
+    mods: int
+    life_bar_graph: str
+    timestamp: datetime.datetime
+    replay_data: memoryview  # LZMA compressed frames, not decompressed
+    replay_id: int
+
+
+def read_osr_header(buffer) -> OsrHeader:
+    """
+    Parse the fields of an .osr held in a bytes-like buffer, leaving the frames compressed.
+    """
+    buffer = memoryview(buffer)
+    mode, game_version = _MODE_VERSION.unpack_from(buffer, 0)
+    offset = _MODE_VERSION.size
+    beatmap_hash, offset = read_string(buffer, offset)
+    username, offset = read_string(buffer, offset)
+    replay_hash, offset = read_string(buffer, offset)
+    counts = _REPLAY_COUNTS.unpack_from(buffer, offset)
+    offset += _REPLAY_COUNTS.size
+    life_bar_graph, offset = read_string(buffer, offset)
+    ticks, replay_length = _TIMESTAMP_LENGTH.unpack_from(buffer, offset)
+    offset += _TIMESTAMP_LENGTH.size
+    replay_data = buffer[offset:offset + replay_length]
+    offset += replay_length
+    # Old replays store the score id as an int
+    if len(buffer) - offset >= _REPLAY_ID.size:
+        replay_id, = _REPLAY_ID.unpack_from(buffer, offset)
+    else:
+        replay_id, = _OLD_REPLAY_ID.unpack_from(buffer, offset)
+
+    return OsrHeader(mode, game_version, beatmap_hash, username, replay_hash, *counts, life_bar_graph,
+                     WINDOWS_EPOCH + datetime.timedelta(microseconds=ticks / 10), replay_data, replay_id)
+
+
+def read_osr(path) -> OsrHeader:
+    with open(path, 'rb') as f:
+        return read_osr_header(f.read())
+
+
+def iter_replay_events(replay_data, chunk_size: int = 1 << 16) -> Iterator[ReplayEventOsu]:
+    """
+    Decompress and parse osu! standard frames chunk by chunk, as osrparse would
+    but without holding the whole decompressed frame string. The trailing RNG
+    seed frame is dropped.
+    """
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_AUTO)
+    replay_data = memoryview(replay_data)
+    pending = b""
+    previous = None
+    for chunk_start in range(0, len(replay_data), chunk_size):
+        pending += decompressor.decompress(replay_data[chunk_start:chunk_start + chunk_size])
+        *frames, pending = pending.split(b",")
+        for frame in frames:
+            if previous is not None:
+                yield _parse_frame(previous)
+            previous = frame
+
+    # Stable ends the string with a comma, some lazer versions do not
+    tail = [frame for frame in (previous, pending) if frame]
+    if tail and tail[-1].startswith(_RNG_SEED_PREFIX):
+        tail.pop()
+    for frame in tail:
+        yield _parse_frame(frame)
+
+
+def _parse_frame(frame: bytes) -> ReplayEventOsu:
+    time_delta, x, y, keys = frame.split(b"|")
+    return ReplayEventOsu(int(time_delta), float(x), float(y), Key(int(keys)))
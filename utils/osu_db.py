@@ -1,11 +1,36 @@
 import logging
+import mmap
+import multiprocessing
+import os
+import struct
+from array import array
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from utils.primitives import osuString, ByteInt, ByteFloat, IntDoublePairs, ByteDouble
+from utils.primitives import osuString, ByteInt, ByteFloat, IntDoublePairs, ByteDouble, read_string, skip_string
+from utils.star_ratings import INT_DOUBLE_PAIR, StarRatings
 
 logger = logging.getLogger(__name__)
 
+# Below this many beatmaps starting worker processes costs more than it saves
+PARALLEL_MIN_BEATMAPS = 20000
+
+# Fixed-size field runs of a beatmap record, also used by utils.osu_db_records to write them, see
+# https://github.com/ppy/osu/wiki/Legacy-database-file-structure
+DB_HEADER = struct.Struct("<IIBQ")  # Version, folder count, account unlocked, date unlocked
+UINT = struct.Struct("<I")
+BEATMAP_STATS = struct.Struct("<BHHHQffffd")  # Ranked status, object counts, last modified, AR/CS/HP/OD, SV
+BEATMAP_TIMES = struct.Struct("<IIII")  # Drain time, total time, preview time, number of timing points
+TIMING_POINT = struct.Struct("<ddB")  # BPM, offset, uninherited
+_BEATMAP_IDS = struct.Struct("<II4s")  # Difficulty id, beatmapset id, thread id
+
 
 class Beatmap:
+    __slots__ = ("artist_name", "artist_unicode", "title", "title_unicode", "creator", "difficulty",
+                 "audio_file", "md5_hash", "name_of_osu_file", "ranked_status", "hc", "slider", "spinner",
+                 "last_modified", "ar", "cs", "hp", "od", "sv", "star_ratings", "drain_time", "total_time", "preview_time",
+                 "beatmap_id", "beatmapset_id", "thread_id", "folder_name")
+
     def __init__(self, file_handle):
         self.artist_name = osuString(file_handle)
         self.artist_unicode = osuString(file_handle)
@@ -26,10 +51,7 @@ class Beatmap:
         self.hp = ByteFloat(file_handle.read(4))  # HP drain
         self.od = ByteFloat(file_handle.read(4))  # Overall difficulty
         self.sv = ByteDouble(file_handle.read(8))  # Slider velocity
-        IntDoublePairs(file_handle)
-        IntDoublePairs(file_handle)
-        IntDoublePairs(file_handle)
-        IntDoublePairs(file_handle)
+        self.star_ratings = StarRatings([IntDoublePairs(file_handle) for _ in range(4)])  # osu!, taiko, ctb, mania
         self.drain_time = ByteInt(file_handle.read(4))  # Drain time
         self.total_time = ByteInt(file_handle.read(4))  # Total time
         self.preview_time = ByteInt(file_handle.read(4))  # Preview time
@@ -85,11 +107,308 @@ class Beatmap:
         _ = file_handle.read(4)  # Last Modification
         _ = file_handle.read(1)  # Mania scroll speed
 
+    @classmethod
+    def from_buffer(cls, buffer, offset):
+        """
+        Decode a beatmap record starting at `offset` of an in-memory osu!.db.
+        Returns the beatmap and the offset of the next record.
+        """
+        beatmap = cls.__new__(cls)
+        beatmap.artist_name, offset = read_string(buffer, offset)
+        beatmap.artist_unicode, offset = read_string(buffer, offset)
+        beatmap.title, offset = read_string(buffer, offset)
+        beatmap.title_unicode, offset = read_string(buffer, offset)
+        beatmap.creator, offset = read_string(buffer, offset)
+        beatmap.difficulty, offset = read_string(buffer, offset)
+        beatmap.audio_file, offset = read_string(buffer, offset)
+        beatmap.md5_hash, offset = read_string(buffer, offset)
+        beatmap.name_of_osu_file, offset = read_string(buffer, offset)
+        (beatmap.ranked_status, beatmap.hc, beatmap.slider, beatmap.spinner, beatmap.last_modified,
+         beatmap.ar, beatmap.cs, beatmap.hp, beatmap.od, beatmap.sv) = BEATMAP_STATS.unpack_from(buffer, offset)
+        offset += BEATMAP_STATS.size
+        beatmap.star_ratings, offset = StarRatings.from_buffer(buffer, offset)
+        (beatmap.drain_time, beatmap.total_time, beatmap.preview_time,
+         nr_of_timings) = BEATMAP_TIMES.unpack_from(buffer, offset)
+        offset += BEATMAP_TIMES.size + nr_of_timings * TIMING_POINT.size
+        beatmap.beatmap_id, beatmap.beatmapset_id, beatmap.thread_id = _BEATMAP_IDS.unpack_from(buffer, offset)
+        offset += _BEATMAP_IDS.size + 4 + 2 + 4 + 1  # Grades, offset, leniency, mode
+        offset = skip_string(buffer, offset)  # Source
+        offset = skip_string(buffer, offset)  # Tags
+        offset += 2  # Online offset
+        offset = skip_string(buffer, offset)  # Font
+        offset += 1 + 8 + 1  # Unplayed, last played, is osz2
+        beatmap.folder_name, offset = read_string(buffer, offset)
+        offset += 8 + 5 + 4 + 1  # Last checked, ignore/disable flags, last modification, mania scroll speed
+        return beatmap, offset
+
+    def star_rating(self, mods: int = 0, mode: int = 0):
+        """
+        Star rating osu! cached for `mods` in `mode`, or None if it has not calculated it.
+        """
+        return self.star_ratings.get(mods, mode)
+
+    def __getstate__(self):
+        # Plain tuple state keeps pickling cheap when pool workers hand beatmaps back
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
     def __hash__(self):
         return hash(self.md5_hash)
 
 
-def parse_osu_db(db_path):
+def _skip_beatmap_tail(buffer, offset):
+    """
+    Return the offset of the next record, given the offset just past a record's md5 hash.
+    """
+    offset = skip_string(buffer, offset)  # Name of .osu file
+    offset += BEATMAP_STATS.size
+    for _ in range(4):  # Star rating tables
+        num_pairs, = UINT.unpack_from(buffer, offset)
+        offset += 4 + num_pairs * INT_DOUBLE_PAIR.size
+    nr_of_timings, = UINT.unpack_from(buffer, offset + 12)
+    offset += BEATMAP_TIMES.size + nr_of_timings * TIMING_POINT.size
+    offset += _BEATMAP_IDS.size + 4 + 2 + 4 + 1  # Grades, offset, leniency, mode
+    offset = skip_string(buffer, offset)  # Source
+    offset = skip_string(buffer, offset)  # Tags
+    offset += 2  # Online offset
+    offset = skip_string(buffer, offset)  # Font
+    offset += 1 + 8 + 1  # Unplayed, last played, is osz2
+    offset = skip_string(buffer, offset)  # Folder name
+    return offset + 8 + 5 + 4 + 1
+
+
+def _read_db_header(buffer):
+    """
+    Returns the number of beatmaps in the database and the offset of the first record.
+    """
+    osu_version, folder_count, account_unlocked, date_unlocked = DB_HEADER.unpack_from(buffer, 0)
+    offset = skip_string(buffer, DB_HEADER.size)  # Player name
+    num_beatmaps, = UINT.unpack_from(buffer, offset)
+    return num_beatmaps, offset + 4
+
+
+def iter_osu_db(db_path) -> Iterator[Beatmap]:
+    """
+    Yield every beatmap of the database in order, one record at a time.
+    """
+    with open(db_path, 'rb') as f:
+        buffer = memoryview(f.read())
+
+    num_beatmaps, offset = _read_db_header(buffer)
+    for beatmap_no in range(num_beatmaps):
+        beatmap, offset = Beatmap.from_buffer(buffer, offset)
+        yield beatmap
+        if beatmap_no % 10000 == 0:
+            logger.info(f"Parsed {beatmap_no} beatmaps.")
+
+
+def parse_osu_db(db_path, processes: int = 1):
+    """
+    Parse osu!.db into an md5 -> Beatmap mapping.
+    With `processes` other than 1 (None for every core) large databases are decoded in parallel.
+    """
+    if processes != 1:
+        return parse_osu_db_parallel(db_path, processes)
+    return {beatmap.md5_hash: beatmap for beatmap in iter_osu_db(db_path)}
+
+
+def scan_record_offsets(buffer, num_beatmaps: int, offset: int) -> List[int]:
+    """
+    Pre-scan the byte offset of every beatmap record by skipping over string lengths only.
+    The list ends with the offset just past the last record.
+    """
+    offsets = [offset]
+    append = offsets.append
+    for _ in range(num_beatmaps):
+        for _ in range(8):  # Artist, title, creator, difficulty, audio and md5 strings
+            offset = skip_string(buffer, offset)
+        offset = _skip_beatmap_tail(buffer, offset)
+        append(offset)
+    return offsets
+
+
+def iter_record_chunk(chunk: Tuple[str, int, int]) -> Iterator[Beatmap]:
+    """
+    Yield the `count` beatmaps of a (db_path, offset, count) chunk, reading through a read-only mmap.
+    """
+    db_path, offset, count = chunk
+    with open(db_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+        buffer = memoryview(db_map)
+        try:
+            for _ in range(count):
+                beatmap, offset = Beatmap.from_buffer(buffer, offset)
+                yield beatmap
+        finally:
+            buffer.release()
+
+
+def plan_record_chunks(db_path, processes: int, min_beatmaps: int = PARALLEL_MIN_BEATMAPS):
+    """
+    Split the records of osu!.db into (db_path, offset, count) chunks for a pool of `processes`
+    workers. Returns None when the database is too small for parallel decoding to pay off.
+    The chunks are yielded lazily by the offset pre-scan, so a pool consuming them starts
+    decoding the first chunks while the rest of the file is still being scanned.
+    """
+    with open(db_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+        buffer = memoryview(db_map)
+        try:
+            num_beatmaps, offset = _read_db_header(buffer)
+        finally:
+            buffer.release()
+    if processes < 2 or num_beatmaps < min_beatmaps:
+        return None
+
+    # A few chunks per process keeps the workers busy when some chunks hold longer records
+    chunk_size = -(-num_beatmaps // (processes * 4))
+    logger.info(f"Splitting {num_beatmaps} beatmaps into chunks of {chunk_size} for {processes} processes.")
+    return _scan_record_chunks(str(db_path), num_beatmaps, offset, chunk_size)
+
+
+def _scan_record_chunks(db_path: str, num_beatmaps: int, offset: int, chunk_size: int) -> Iterator[Tuple[str, int, int]]:
+    with open(db_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+        buffer = memoryview(db_map)
+        try:
+            for start in range(0, num_beatmaps, chunk_size):
+                count = min(chunk_size, num_beatmaps - start)
+                yield db_path, offset, count
+                if start + count < num_beatmaps:
+                    offset = scan_record_offsets(buffer, count, offset)[-1]
+        finally:
+            buffer.release()
+
+
+def map_record_chunks(db_path, chunk_function: Callable, processes: int = None,
+                      min_beatmaps: int = PARALLEL_MIN_BEATMAPS) -> Optional[Iterator]:
+    """
+    Run `chunk_function` over the (db_path, offset, count) record chunks of osu!.db on a pool
+    of `processes` workers (None for every core), yielding the results in database order.
+    Returns None for a single process or a database too small to split, so the caller can
+    take its serial path. Results are pickled back, so they should be compact rows or columns.
+    """
+    if processes == 1:
+        return None
+    processes = processes or os.cpu_count() or 1
+    chunks = plan_record_chunks(db_path, processes, min_beatmaps)
+    if chunks is None:
+        return None
+    return _imap_record_chunks(chunk_function, chunks, processes)
+
+
+def _imap_record_chunks(chunk_function: Callable, chunks: Iterator, processes: int) -> Iterator:
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap(chunk_function, chunks)
+
+
+def _index_record_chunk(chunk: Tuple[str, int, int]) -> Tuple[List[str], array]:
+    """
+    md5 hash and record offset of every beatmap in a chunk, skipping over everything else.
+    """
+    db_path, offset, count = chunk
+    md5_hashes = []
+    offsets = array('Q')
+    with open(db_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+        buffer = memoryview(db_map)
+        try:
+            for _ in range(count):
+                offsets.append(offset)
+                md5_offset = offset
+                for _ in range(7):  # Artist, title, creator, difficulty and audio strings
+                    md5_offset = skip_string(buffer, md5_offset)
+                md5_hash, tail_offset = read_string(buffer, md5_offset)
+                md5_hashes.append(md5_hash)
+                offset = _skip_beatmap_tail(buffer, tail_offset)
+        finally:
+            buffer.release()
+    return md5_hashes, offsets
+
+
+class LazyBeatmaps(Mapping):
+    """
+    md5 -> Beatmap over osu!.db held in memory, decoding each record on first access.
+    Like a dict built in database order, the last duplicate record wins.
+    """
+
+    def __init__(self, buffer, offsets: Dict[str, int]):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.decoded = {}
+
+    def __getitem__(self, md5_hash):
+        beatmap = self.decoded.get(md5_hash)
+        if beatmap is None:
+            beatmap, _ = Beatmap.from_buffer(self.buffer, self.offsets[md5_hash])
+            self.decoded[md5_hash] = beatmap
+        return beatmap
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, md5_hash):
+        return md5_hash in self.offsets
+
+
+def parse_osu_db_parallel(db_path, processes: int = None, min_beatmaps: int = PARALLEL_MIN_BEATMAPS):
+    """
+    Index osu!.db across a process pool. Workers only send back the md5 hash and offset of
+    each record, and Beatmaps are decoded from the file in memory when first looked up.
+    This suits looking up part of a large library; to decode every beatmap use
+    parse_osu_db, or BeatmapTable.from_osu_db for columns decoded in parallel.
+    Small databases, or a single process, take the serial path.
+    """
+    results = map_record_chunks(db_path, _index_record_chunk, processes, min_beatmaps)
+    if results is None:
+        return parse_osu_db(db_path)
+
+    offsets = {}
+    for md5_hashes, record_offsets in results:
+        offsets.update(zip(md5_hashes, record_offsets))
+    with open(db_path, 'rb') as f:
+        buffer = f.read()
+    return LazyBeatmaps(buffer, offsets)
+
+
+def lookup_beatmaps(db_path, hashes: Iterable[str]) -> Iterator[Beatmap]:
+    """
+    Yield the beatmaps whose md5 hash is in `hashes`, in database order.
+    Only matching records are decoded; every other record is skipped over by
+    its string lengths, and the scan stops once all hashes have been found.
+    """
+    wanted = set(hashes)
+    if not wanted:
+        return
+
+    with open(db_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+        buffer = memoryview(db_map)
+        try:
+            num_beatmaps, offset = _read_db_header(buffer)
+            for _ in range(num_beatmaps):
+                md5_offset = offset
+                for _ in range(7):  # Artist, title, creator, difficulty and audio strings
+                    md5_offset = skip_string(buffer, md5_offset)
+                md5_hash, tail_offset = read_string(buffer, md5_offset)
+                if md5_hash in wanted:
+                    beatmap, offset = Beatmap.from_buffer(buffer, offset)
+                    yield beatmap
+                    wanted.discard(md5_hash)
+                    if not wanted:
+                        return
+                else:
+                    offset = _skip_beatmap_tail(buffer, tail_offset)
+        finally:
+            buffer.release()
+
+
+def parse_osu_db_stream(db_path):
+    """
+    Reference parser reading the database field by field from the file handle.
+    Kept for benchmarking and cross-checking `parse_osu_db`.
+    """
     with open(db_path, 'rb') as f:
         osu_version = ByteInt(f.read(4))
         folder_count = ByteInt(f.read(4))
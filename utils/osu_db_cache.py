@@ -0,0 +1,149 @@
+import logging
+import os
+import sqlite3
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+from typing import NamedTuple
+
+from utils.osu_db import PARALLEL_MIN_BEATMAPS, iter_osu_db, iter_record_chunk, map_record_chunks
+from utils.star_ratings import common_star_rating
+
+logger = logging.getLogger(__name__)
+
+CACHE_SCHEMA_VERSION = 2
+DEFAULT_CACHE_PATH = Path("osu_db_index.sqlite")
+
+
+class BeatmapIndexEntry(NamedTuple):
+    md5_hash: str
+    folder_name: str
+    name_of_osu_file: str
+    beatmap_id: int
+    beatmapset_id: int
+    ar: float
+    cs: float
+    hp: float
+    od: float
+    drain_time: int
+    total_time: int
+    preview_time: int
+    star_ratings: bytes  # array('f') over COMMON_MODS, NaN where osu! has none cached
+
+    def star_rating(self, mods: int = 0):
+        return common_star_rating(array('f', self.star_ratings), mods)
+
+
+_COLUMNS = ", ".join(BeatmapIndexEntry._fields)
+
+
+class OsuDbIndex(Mapping):
+    """
+    Read-only md5 -> BeatmapIndexEntry mapping backed by the SQLite cache.
+    Rows are fetched on access, so opening the index costs a single query.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __getitem__(self, md5_hash):
+        row = self.connection.execute(f"SELECT {_COLUMNS} FROM beatmaps WHERE md5_hash = ?",
+                                      (md5_hash,)).fetchone()
+        if row is None:
+            raise KeyError(md5_hash)
+        return BeatmapIndexEntry(*row)
+
+    def __iter__(self):
+        for md5_hash, in self.connection.execute("SELECT md5_hash FROM beatmaps"):
+            yield md5_hash
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM beatmaps").fetchone()[0]
+
+    def __contains__(self, md5_hash):
+        return self.connection.execute("SELECT 1 FROM beatmaps WHERE md5_hash = ?",
+                                       (md5_hash,)).fetchone() is not None
+
+    def close(self):
+        self.connection.close()
+
+
+def _db_fingerprint(db_path):
+    stat = os.stat(db_path)
+    with open(db_path, 'rb') as f:
+        osu_version = int.from_bytes(f.read(4), byteorder="little")
+    return {"schema_version": str(CACHE_SCHEMA_VERSION),
+            "db_path": str(Path(db_path).resolve()),
+            "mtime_ns": str(stat.st_mtime_ns),
+            "size": str(stat.st_size),
+            "osu_version": str(osu_version)}
+
+
+def _index_row(beatmap) -> tuple:
+    return (beatmap.md5_hash, beatmap.folder_name, beatmap.name_of_osu_file, beatmap.beatmap_id,
+            beatmap.beatmapset_id, beatmap.ar, beatmap.cs, beatmap.hp, beatmap.od, beatmap.drain_time,
+            beatmap.total_time, beatmap.preview_time, beatmap.star_ratings.common().tobytes())
+
+
+def _index_rows_from_chunk(chunk) -> list:
+    return [_index_row(beatmap) for beatmap in iter_record_chunk(chunk)]
+
+
+def _iter_index_rows(db_path, processes: int = 1, min_beatmaps: int = PARALLEL_MIN_BEATMAPS):
+    """
+    Index rows of every beatmap in database order. With `processes` other than 1 (None for every
+    core) large databases are decoded by a pool whose workers send back only the rows, which are
+    a fraction of the Beatmap objects to pickle.
+    """
+    chunk_rows = map_record_chunks(db_path, _index_rows_from_chunk, processes, min_beatmaps)
+    if chunk_rows is not None:
+        for rows in chunk_rows:
+            yield from rows
+        return
+    for beatmap in iter_osu_db(db_path):
+        yield _index_row(beatmap)
+
+
+def _rebuild_index(connection: sqlite3.Connection, db_path, fingerprint, processes: int = 1):
+    logger.info(f"Rebuilding osu!.db index cache from {db_path}.")
+    with connection:
+        connection.execute("DROP TABLE IF EXISTS beatmaps")
+        connection.execute("DROP TABLE IF EXISTS meta")
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("CREATE TABLE beatmaps ("
+                           "md5_hash TEXT PRIMARY KEY, folder_name TEXT, name_of_osu_file TEXT, "
+                           "beatmap_id INTEGER, beatmapset_id INTEGER, "
+                           "ar REAL, cs REAL, hp REAL, od REAL, "
+                           "drain_time INTEGER, total_time INTEGER, preview_time INTEGER, star_ratings BLOB"
+                           ") WITHOUT ROWID")
+        # Later duplicates replace earlier ones, as in parse_osu_db
+        connection.executemany(f"INSERT OR REPLACE INTO beatmaps ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               _iter_index_rows(db_path, processes))
+        connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", fingerprint.items())
+
+
+def load_osu_db_index(db_path, cache_path=DEFAULT_CACHE_PATH, processes: int = 1) -> OsuDbIndex:
+    """
+    Open the beatmap index for `db_path`, rebuilding the cache at `cache_path`
+    only when osu!.db's mtime, size or version header changed since it was built.
+    `processes` sets how many processes decode osu!.db for the rebuild.
+    """
+    fingerprint = _db_fingerprint(db_path)
+    connection = sqlite3.connect(cache_path)
+    try:
+        cached_fingerprint = dict(connection.execute("SELECT key, value FROM meta"))
+    except sqlite3.OperationalError:
+        cached_fingerprint = {}
+    except sqlite3.DatabaseError:
+        logger.warning(f"Discarding unreadable osu!.db index cache {cache_path}.")
+        connection.close()
+        os.remove(cache_path)
+        connection = sqlite3.connect(cache_path)
+        cached_fingerprint = {}
+
+    if cached_fingerprint != fingerprint:
+        _rebuild_index(connection, db_path, fingerprint, processes)
+    else:
+        logger.info(f"Using cached osu!.db index from {cache_path}.")
+
+    return OsuDbIndex(connection)
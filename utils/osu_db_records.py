@@ -0,0 +1,346 @@
+"""
+Full-fidelity osu!.db and collection.db records and streaming writers.
+
+Unlike `utils.osu_db.Beatmap`, which keeps only the fields the scripts read,
+an OsuDbRecord holds every field of a beatmap entry so databases can be
+written back out, e.g. trimmed down to a tournament's mappool.
+"""
+import logging
+import io
+import mmap
+import os
+import struct
+import tempfile
+import unittest
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from utils.leb128 import encode_uleb128
+from utils.osu_db import BEATMAP_STATS, BEATMAP_TIMES, DB_HEADER, TIMING_POINT, UINT
+from utils.primitives import read_string
+from utils.star_ratings import StarRatings
+
+logger = logging.getLogger(__name__)
+
+_BEATMAP_IDS_AND_GRADES = struct.Struct("<IIIBBBBhfB")  # Ids, thread id, grades, local offset, stack leniency, mode
+_ONLINE_OFFSET = struct.Struct("<h")
+_PLAY_STATE = struct.Struct("<BQB")  # Unplayed, last played, is osz2
+_BEATMAP_FLAGS = struct.Struct("<QBBBBBIB")  # Last checked, ignore/disable flags, last modification, mania scroll speed
+
+
+class TimingPoint(NamedTuple):
+    bpm: float
+    offset: float
+    uninherited: int
+
+
+class OsuDbHeader(NamedTuple):
+    osu_version: int
+    folder_count: int
+    account_unlocked: int
+    date_unlocked: int
+    player_name: str
+    num_beatmaps: int
+
+
+class OsuDbRecord:
+    """
+    Every field of an osu!.db beatmap entry, in file order.
+    """
+    __slots__ = ("artist_name", "artist_unicode", "title", "title_unicode", "creator", "difficulty",
+                 "audio_file", "md5_hash", "name_of_osu_file", "ranked_status", "hc", "slider", "spinner",
+                 "last_modified", "ar", "cs", "hp", "od", "sv", "star_ratings", "drain_time", "total_time",
+                 "preview_time", "timing_points", "beatmap_id", "beatmapset_id", "thread_id", "grade_osu",
+                 "grade_taiko", "grade_catch", "grade_mania", "local_offset", "stack_leniency", "mode", "source",
+                 "tags", "online_offset", "font", "unplayed", "last_played", "is_osz2", "folder_name",
+                 "last_checked", "ignore_sound", "ignore_skin", "disable_storyboard", "disable_video",
+                 "visual_override", "last_modification", "mania_scroll_speed")
+
+    @classmethod
+    def from_buffer(cls, buffer, offset):
+        """
+        Decode the record starting at `offset`, returning it with the offset of the next record.
+        """
+        record = cls.__new__(cls)
+        record.artist_name, offset = read_string(buffer, offset)
+        record.artist_unicode, offset = read_string(buffer, offset)
+        record.title, offset = read_string(buffer, offset)
+        record.title_unicode, offset = read_string(buffer, offset)
+        record.creator, offset = read_string(buffer, offset)
+        record.difficulty, offset = read_string(buffer, offset)
+        record.audio_file, offset = read_string(buffer, offset)
+        record.md5_hash, offset = read_string(buffer, offset)
+        record.name_of_osu_file, offset = read_string(buffer, offset)
+        (record.ranked_status, record.hc, record.slider, record.spinner, record.last_modified,
+         record.ar, record.cs, record.hp, record.od, record.sv) = BEATMAP_STATS.unpack_from(buffer, offset)
+        offset += BEATMAP_STATS.size
+        record.star_ratings, offset = StarRatings.from_buffer(buffer, offset)
+        (record.drain_time, record.total_time, record.preview_time,
+         nr_of_timings) = BEATMAP_TIMES.unpack_from(buffer, offset)
+        offset += BEATMAP_TIMES.size
+        record.timing_points = list(map(TimingPoint._make, TIMING_POINT.iter_unpack(
+            buffer[offset:offset + nr_of_timings * TIMING_POINT.size])))
+        offset += nr_of_timings * TIMING_POINT.size
+        (record.beatmap_id, record.beatmapset_id, record.thread_id, record.grade_osu, record.grade_taiko,
+         record.grade_catch, record.grade_mania, record.local_offset, record.stack_leniency,
+         record.mode) = _BEATMAP_IDS_AND_GRADES.unpack_from(buffer, offset)
+        offset += _BEATMAP_IDS_AND_GRADES.size
+        record.source, offset = read_string(buffer, offset)
+        record.tags, offset = read_string(buffer, offset)
+        record.online_offset, = _ONLINE_OFFSET.unpack_from(buffer, offset)
+        offset += _ONLINE_OFFSET.size
+        record.font, offset = read_string(buffer, offset)
+        record.unplayed, record.last_played, record.is_osz2 = _PLAY_STATE.unpack_from(buffer, offset)
+        offset += _PLAY_STATE.size
+        record.folder_name, offset = read_string(buffer, offset)
+        (record.last_checked, record.ignore_sound, record.ignore_skin, record.disable_storyboard,
+         record.disable_video, record.visual_override, record.last_modification,
+         record.mania_scroll_speed) = _BEATMAP_FLAGS.unpack_from(buffer, offset)
+        offset += _BEATMAP_FLAGS.size
+        return record, offset
+
+    def __eq__(self, other):
+        if not isinstance(other, OsuDbRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"OsuDbRecord({self.md5_hash}, {self.folder_name}/{self.name_of_osu_file})"
+
+
+def read_osu_db_header(buffer) -> Tuple[OsuDbHeader, int]:
+    """
+    Decode the database header, returning it with the offset of the first record.
+    """
+    osu_version, folder_count, account_unlocked, date_unlocked = DB_HEADER.unpack_from(buffer, 0)
+    player_name, offset = read_string(buffer, DB_HEADER.size)
+    num_beatmaps, = UINT.unpack_from(buffer, offset)
+    header = OsuDbHeader(osu_version, folder_count, account_unlocked, date_unlocked, player_name, num_beatmaps)
+    return header, offset + UINT.size
+
+
+def iter_osu_db_records(buffer) -> Iterator[OsuDbRecord]:
+    header, offset = read_osu_db_header(buffer)
+    for _ in range(header.num_beatmaps):
+        record, offset = OsuDbRecord.from_buffer(buffer, offset)
+        yield record
+
+
+class BinaryWriter:
+    """
+    Buffered little-endian writer that packs values into one reused bytearray
+    and hands it to the file handle whenever it grows past `flush_size`.
+    """
+
+    def __init__(self, file_handle: BinaryIO, flush_size: int = 1 << 16):
+        self.file_handle = file_handle
+        self.flush_size = flush_size
+        self.buffer = bytearray()
+
+    def pack(self, layout: struct.Struct, *values):
+        self.buffer += layout.pack(*values)
+
+    def write_string(self, data: str):
+        if data:
+            encoded = data.encode("utf-8")
+            self.buffer.append(0x0b)
+            self.buffer += encode_uleb128(len(encoded))
+            self.buffer += encoded
+        else:
+            self.buffer.append(0x00)
+
+    def maybe_flush(self):
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        self.file_handle.write(self.buffer)
+        del self.buffer[:]
+
+
+class OsuDbWriter(BinaryWriter):
+
+    def write_header(self, header: OsuDbHeader):
+        self.pack(DB_HEADER, header.osu_version, header.folder_count, header.account_unlocked,
+                  header.date_unlocked)
+        self.write_string(header.player_name)
+        self.pack(UINT, header.num_beatmaps)
+
+    def write_record(self, record: OsuDbRecord):
+        for string in (record.artist_name, record.artist_unicode, record.title, record.title_unicode,
+                       record.creator, record.difficulty, record.audio_file, record.md5_hash,
+                       record.name_of_osu_file):
+            self.write_string(string)
+        self.pack(BEATMAP_STATS, record.ranked_status, record.hc, record.slider, record.spinner,
+                  record.last_modified, record.ar, record.cs, record.hp, record.od, record.sv)
+        self.buffer += record.star_ratings.to_bytes()
+        self.pack(BEATMAP_TIMES, record.drain_time, record.total_time, record.preview_time,
+                  len(record.timing_points))
+        for timing_point in record.timing_points:
+            self.pack(TIMING_POINT, timing_point.bpm, timing_point.offset, timing_point.uninherited)
+        self.pack(_BEATMAP_IDS_AND_GRADES, record.beatmap_id, record.beatmapset_id, record.thread_id, record.grade_osu,
+                  record.grade_taiko, record.grade_catch, record.grade_mania, record.local_offset,
+                  record.stack_leniency, record.mode)
+        self.write_string(record.source)
+        self.write_string(record.tags)
+        self.pack(_ONLINE_OFFSET, record.online_offset)
+        self.write_string(record.font)
+        self.pack(_PLAY_STATE, record.unplayed, record.last_played, record.is_osz2)
+        self.write_string(record.folder_name)
+        self.pack(_BEATMAP_FLAGS, record.last_checked, record.ignore_sound, record.ignore_skin,
+                  record.disable_storyboard, record.disable_video, record.visual_override,
+                  record.last_modification, record.mania_scroll_speed)
+        self.maybe_flush()
+
+    def write_user_permissions(self, user_permissions: int):
+        self.pack(UINT, user_permissions)
+
+
+def write_osu_db(file_handle: BinaryIO, header: OsuDbHeader, records: Iterable[OsuDbRecord],
+                 user_permissions: int = 0):
+    """
+    Write a complete osu!.db. `header.num_beatmaps` must match the number of records.
+    """
+    writer = OsuDbWriter(file_handle)
+    writer.write_header(header)
+    written = 0
+    for record in records:
+        writer.write_record(record)
+        written += 1
+    writer.write_user_permissions(user_permissions)
+    writer.flush()
+    if written != header.num_beatmaps:
+        msg = 'Header announces {} beatmaps but {} were written'.format(header.num_beatmaps, written)
+        raise ValueError(msg)
+
+
+def write_trimmed_osu_db(src_db_path, dst_db_path, keep: Callable[[OsuDbRecord], bool]) -> List[OsuDbRecord]:
+    """
+    Copy the entries of `src_db_path` for which `keep` is true into a new osu!.db at `dst_db_path`.
+    Returns the kept records. When entries are dropped the header's folder count is
+    set to the number of distinct folders left, otherwise the header is copied as is.
+    """
+    with open(src_db_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_map:
+        buffer = memoryview(db_map)
+        try:
+            header, offset = read_osu_db_header(buffer)
+            kept = []
+            for _ in range(header.num_beatmaps):
+                record, offset = OsuDbRecord.from_buffer(buffer, offset)
+                if keep(record):
+                    kept.append(record)
+            if len(buffer) >= offset + UINT.size:
+                user_permissions, = UINT.unpack_from(buffer, offset)
+            else:
+                user_permissions = 0
+        finally:
+            buffer.release()
+
+    if len(kept) == header.num_beatmaps:
+        trimmed_header = header
+    else:
+        trimmed_header = header._replace(folder_count=len({record.folder_name for record in kept}),
+                                         num_beatmaps=len(kept))
+    with open(dst_db_path, 'wb') as f:
+        write_osu_db(f, trimmed_header, kept, user_permissions)
+    logger.info(f"Wrote {len(kept)} of {header.num_beatmaps} beatmaps to {dst_db_path}.")
+    return kept
+
+
+def read_collection_db(db_path) -> Tuple[int, Dict[str, List[str]]]:
+    """
+    Returns the collection.db version and its collections as name -> md5 hashes.
+    """
+    with open(db_path, 'rb') as f:
+        buffer = memoryview(f.read())
+    version, num_collections = struct.unpack_from("<II", buffer, 0)
+    offset = 8
+    collections = {}
+    for _ in range(num_collections):
+        name, offset = read_string(buffer, offset)
+        num_hashes, = UINT.unpack_from(buffer, offset)
+        offset += UINT.size
+        hashes = []
+        for _ in range(num_hashes):
+            md5_hash, offset = read_string(buffer, offset)
+            hashes.append(md5_hash)
+        collections[name] = hashes
+    return version, collections
+
+
+def write_collection_db(file_handle: BinaryIO, version: int, collections: Dict[str, List[str]]):
+    writer = BinaryWriter(file_handle)
+    writer.pack(UINT, version)
+    writer.pack(UINT, len(collections))
+    for name, hashes in collections.items():
+        writer.write_string(name)
+        writer.pack(UINT, len(hashes))
+        for md5_hash in hashes:
+            writer.write_string(md5_hash)
+        writer.maybe_flush()
+    writer.flush()
+
+
+def _test_record(number: int) -> OsuDbRecord:
+    record = OsuDbRecord.__new__(OsuDbRecord)
+    for name in ("artist_name", "artist_unicode", "title", "title_unicode", "creator", "difficulty",
+                 "audio_file", "name_of_osu_file", "source", "tags", "font"):
+        setattr(record, name, f"{name} {number}" if number % 3 else "")
+    record.title_unicode = f"タイトル {number}"
+    record.md5_hash = f"{number:032x}"
+    record.folder_name = f"{number // 2} Artist - Title"
+    (record.ranked_status, record.hc, record.slider, record.spinner, record.last_modified) = (4, 100, 50, 1, 2 ** 40)
+    record.ar, record.cs, record.hp, record.od, record.sv = 9.5, 4.0, 6.0, 8.5, 1.4
+    record.star_ratings = StarRatings([[(0, 5.25), (64, 7.5)], [], [(16, 3.0)], []])
+    record.drain_time, record.total_time, record.preview_time = 180, 185000, 60000
+    record.timing_points = [TimingPoint(333.33, 1200.0, 1), TimingPoint(-100.0, 5000.0, 0)]
+    (record.beatmap_id, record.beatmapset_id, record.thread_id) = (1000 + number, 500 + number // 2, 0)
+    record.grade_osu, record.grade_taiko, record.grade_catch, record.grade_mania = 0, 9, 9, 9
+    record.local_offset, record.stack_leniency, record.mode, record.online_offset = -5, 0.5, 0, 10
+    record.unplayed, record.last_played, record.is_osz2 = 0, 2 ** 50, 0
+    (record.last_checked, record.ignore_sound, record.ignore_skin, record.disable_storyboard,
+     record.disable_video, record.visual_override, record.last_modification,
+     record.mania_scroll_speed) = (2 ** 51, 0, 1, 0, 1, 0, 12345, 20)
+    return record
+
+
+class TestOsuDbRecordRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [_test_record(number) for number in range(5)]
+        self.header = OsuDbHeader(osu_version=20231016, folder_count=7, account_unlocked=1, date_unlocked=0,
+                                  player_name="player", num_beatmaps=len(self.records))
+        db_file = io.BytesIO()
+        write_osu_db(db_file, self.header, self.records, user_permissions=1)
+        self.db_bytes = db_file.getvalue()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "osu!.db")
+        with open(self.db_path, "wb") as f:
+            f.write(self.db_bytes)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_read(self):
+        header, offset = read_osu_db_header(self.db_bytes)
+        self.assertEqual(header, self.header)
+        self.assertEqual(list(iter_osu_db_records(self.db_bytes)), self.records)
+
+    def test_trim_keeping_everything_is_a_copy(self):
+        trimmed_path = os.path.join(self.tmp_dir.name, "trimmed.db")
+        write_trimmed_osu_db(self.db_path, trimmed_path, lambda record: True)
+        with open(trimmed_path, "rb") as f:
+            self.assertEqual(f.read(), self.db_bytes)
+
+    def test_trim_recounts_folders(self):
+        trimmed_path = os.path.join(self.tmp_dir.name, "trimmed.db")
+        kept = write_trimmed_osu_db(self.db_path, trimmed_path, lambda record: record.beatmap_id < 1003)
+        with open(trimmed_path, "rb") as f:
+            trimmed_bytes = f.read()
+        header, _ = read_osu_db_header(trimmed_bytes)
+        self.assertEqual(header, self.header._replace(folder_count=2, num_beatmaps=3))
+        self.assertEqual(list(iter_osu_db_records(trimmed_bytes)), kept)
+        self.assertEqual(kept, self.records[:3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+from typing import Tuple
+
+_HIT_OBJECTS_HEADER = b"[HitObjects]"
+
+
+def _hit_object_time(line: bytes) -> float:
+    # x,y,time,type,...
+    return float(line.split(b",", 3)[2])
+
+
+def hit_object_time_range(path) -> Tuple[float, float]:
+    """
+    Start times in milliseconds of the first and last hit object of a .osu file,
+    read from the [HitObjects] section without parsing the objects or their curves.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    section_start = data.find(_HIT_OBJECTS_HEADER)
+    if section_start < 0:
+        raise ValueError(f"{path} has no [HitObjects] section.")
+    hit_objects = data[section_start + len(_HIT_OBJECTS_HEADER):]
+    # [HitObjects] is the last section in practice, but stop at another one if it is not
+    next_section = hit_objects.find(b"\n[")
+    if next_section >= 0:
+        hit_objects = hit_objects[:next_section]
+    hit_objects = hit_objects.strip()
+    if not hit_objects:
+        raise ValueError(f"{path} has no hit objects.")
+
+    first_line = hit_objects.split(b"\n", 1)[0]
+    last_line = hit_objects.rsplit(b"\n", 1)[-1]
+    return _hit_object_time(first_line), _hit_object_time(last_line)
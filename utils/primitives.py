@@ -1,7 +1,7 @@
 import struct
 from typing import BinaryIO
 
-from utils.leb128 import Uleb128
+from utils.leb128 import encode_uleb128, read_uleb128, read_uleb128_stream
 
 
 class osuString:
@@ -10,7 +10,7 @@ class osuString:
         string_header = file_handle.read(1)
         string = b""
         if string_header == b'\x0b':
-            string_length = Uleb128(0).decode_from_stream(file_handle, 'read', 1)
+            string_length = read_uleb128_stream(file_handle)
             string = file_handle.read(string_length)
 
         return string.decode()
@@ -18,24 +18,42 @@ class osuString:
     @staticmethod
     def write_string(data: str, file_handle: BinaryIO):
         if len(data) > 0:
-            file_handle.write(struct.pack("<B", 0x0b))
-            strlen = b""
-            value = len(data)
-            while value != 0:
-                byte = (value & 0x7F)
-                value >>= 7
-                if (value != 0):
-                    byte |= 0x80
-                strlen += struct.pack("<B", byte)
-            write_data = b''
-            write_data += strlen
-            write_data += struct.pack("<" + str(len(data)) +
-                                      "s", data.encode("utf-8"))
-            file_handle.write(write_data)
+            encoded = data.encode("utf-8")
+            file_handle.write(b'\x0b' + encode_uleb128(len(encoded)) + encoded)
         else:
             file_handle.write(struct.pack("<B", 0x00))
 
 
+def _string_bounds(buffer, offset):
+    """
+    Payload start and end of the osu! string at `offset` of a bytes-like buffer.
+    Lengths under 128 are a single byte and skip the varint decoder call.
+    """
+    if buffer[offset] != 0x0b:
+        return offset + 1, offset + 1
+    length = buffer[offset + 1]
+    if length < 0x80:
+        start = offset + 2
+    else:
+        length, start = read_uleb128(buffer, offset + 1)
+    return start, start + length
+
+
+def read_string(buffer, offset):
+    """
+    Decode the osu! string at `offset`, returning it with the offset past its end.
+    """
+    start, end = _string_bounds(buffer, offset)
+    return str(buffer[start:end], "utf-8"), end
+
+
+def skip_string(buffer, offset):
+    """
+    Offset past the osu! string at `offset`, without touching its payload.
+    """
+    return _string_bounds(buffer, offset)[1]
+
+
 class ByteInt:
     def __new__(cls, value):
         return int.from_bytes(value, byteorder="little")
@@ -43,17 +61,16 @@ class ByteInt:
 
 class ByteFloat:
     def __new__(cls, value):
-        return struct.unpack('f', value)
+        return struct.unpack('<f', value)[0]
 
 
 class ByteDouble:
 
     def __new__(cls, value):
-        return struct.unpack('d', value)
+        return struct.unpack('<d', value)[0]
 
 
 class IntDoublePairs:
     def __new__(cls, file_handle):
         num_pairs = ByteInt(file_handle.read(4))
-        for _ in range(num_pairs):
-            _ = file_handle.read(14)
+        return [(mods, stars) for mods, stars in struct.iter_unpack("<xIxd", file_handle.read(num_pairs * 14))]
@@ -0,0 +1,94 @@
+"""
+Concurrent danser-cli renders with ffmpeg remuxing overlapped.
+
+Every job gets its own danser settings file, so renders no longer share the
+single danser_config.json and several can run at once. Settings files are
+kept between runs and only rewritten when their content changes. A finished
+render is handed to a separate ffmpeg pool while the worker moves on to the
+next replay.
+"""
+import logging
+import os
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional
+
+from utils.files import write_if_changed
+
+logger = logging.getLogger(__name__)
+
+DANSER_ARGS = ("danser-cli", "-noupdatecheck", "-record", "-preciseprogress")
+DANSER_DIR = Path("C:\\danser")
+
+
+class RenderJob(NamedTuple):
+    replay_file: Path
+    skin: str
+    name: str  # danser -out name and settings file name
+    settings: bytes  # danser settings JSON
+    output_file: Path  # Remuxed video
+    done_file: Path  # Where the replay is moved once its video is written
+    start: Optional[float] = None  # Clip bounds in seconds, the whole replay if None
+    end: Optional[float] = None
+    length: Optional[str] = None  # ffmpeg -to, e.g. "00:01:00"
+
+
+class RenderQueue:
+
+    def __init__(self, danser_workers: int = 2, ffmpeg_workers: int = 2, danser_dir: Path = DANSER_DIR,
+                 danser_args=DANSER_ARGS):
+        self.danser_workers = danser_workers
+        self.ffmpeg_workers = ffmpeg_workers
+        self.danser_dir = Path(danser_dir)
+        self.danser_args = list(danser_args)
+
+    def settings_path(self, job: RenderJob) -> Path:
+        return self.danser_dir / "settings" / f"{job.name}.json"
+
+    def write_settings(self, job: RenderJob):
+        if not write_if_changed(self.settings_path(job), job.settings):
+            logger.debug(f"Settings of {job.name} are unchanged.")
+
+    def danser_command(self, job: RenderJob) -> List[str]:
+        command = self.danser_args + ["-replay", f"{job.replay_file}", "-skin", job.skin, "-out", job.name]
+        if job.start is not None:
+            command += ["-start", f"{job.start}", "-end", f"{job.end}"]
+        return command + [f"-settings={job.name}"]
+
+    def ffmpeg_command(self, job: RenderJob) -> List[str]:
+        command = ["ffmpeg", "-y"]
+        if job.length is not None:
+            command += ["-to", job.length]
+        return command + ["-i", f"{self.danser_dir / 'videos' / job.name}.mp4",
+                          "-c:v", "copy", "-c:a", "copy",
+                          "-avoid_negative_ts", "1", f"{job.output_file}"]
+
+    def _render(self, job: RenderJob, remux_pool: ThreadPoolExecutor) -> Optional[Future]:
+        self.write_settings(job)
+        logger.info(f"Rendering {job.replay_file}.")
+        result = subprocess.run(self.danser_command(job))
+        if result.returncode != 0:
+            logger.error(f"danser failed on {job.replay_file} with exit code {result.returncode}, "
+                         f"leaving the replay in place.")
+            return None
+        return remux_pool.submit(self._remux, job)
+
+    def _remux(self, job: RenderJob) -> bool:
+        result = subprocess.run(self.ffmpeg_command(job))
+        if result.returncode != 0:
+            logger.error(f"ffmpeg failed on {job.name} with exit code {result.returncode}.")
+            return False
+        os.rename(job.replay_file, job.done_file)
+        logger.info(f"Wrote {job.output_file}.")
+        return True
+
+    def run(self, jobs: Iterable[RenderJob]) -> List[bool]:
+        """
+        Render and remux every job, returning whether each one produced its video.
+        """
+        with ThreadPoolExecutor(self.ffmpeg_workers) as remux_pool, \
+                ThreadPoolExecutor(self.danser_workers) as render_pool:
+            renders = [render_pool.submit(self._render, job, remux_pool) for job in jobs]
+            remuxes = [render.result() for render in renders]
+            return [remux is not None and remux.result() for remux in remuxes]
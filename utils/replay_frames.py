@@ -0,0 +1,115 @@
+from typing import Iterable, List
+
+import numpy as np
+from osrparse import Key, Replay, ReplayEventOsu
+
+FRAME_DTYPE = np.dtype([("time", np.int64),  # Absolute time, the running sum of time_delta
+                        ("time_delta", np.int64),
+                        ("x", np.float64),
+                        ("y", np.float64),
+                        ("keys", np.int32)])
+
+# Both mouse buttons and both keyboard keys, smoke is not a press
+PRESS_KEYS = Key.M1 | Key.M2 | Key.K1 | Key.K2
+
+
+class HitEvents:
+    """
+    Key presses of a replay as parallel arrays: press time in integer
+    milliseconds, the frame's keys, cursor position and frame index.
+    """
+    __slots__ = ("time", "keys", "x", "y", "frame_idx")
+
+    def __init__(self, time: np.ndarray, keys: np.ndarray, x: np.ndarray, y: np.ndarray, frame_idx: np.ndarray):
+        self.time = time
+        self.keys = keys
+        self.x = x
+        self.y = y
+        self.frame_idx = frame_idx
+
+    def __len__(self):
+        return len(self.time)
+
+    def __repr__(self):
+        return f"HitEvents({len(self)} presses)"
+
+
+class ReplayFrames:
+    """
+    osu! standard replay frames as one structured NumPy array.
+
+    Holds exactly what osrparse's ReplayEventOsu objects hold, plus absolute
+    times, so frames can be analysed and edited in bulk and written back.
+    """
+    __slots__ = ("frames",)
+
+    def __init__(self, frames: np.ndarray):
+        self.frames = frames
+
+    @classmethod
+    def from_events(cls, events: Iterable[ReplayEventOsu]):
+        events = list(events)
+        frames = np.empty(len(events), dtype=FRAME_DTYPE)
+        frames["time_delta"] = [event.time_delta for event in events]
+        frames["x"] = [event.x for event in events]
+        frames["y"] = [event.y for event in events]
+        frames["keys"] = [int(event.keys) for event in events]
+        np.cumsum(frames["time_delta"], out=frames["time"])
+        return cls(frames)
+
+    @classmethod
+    def from_replay(cls, replay: Replay):
+        return cls.from_events(replay.replay_data)
+
+    @property
+    def time(self) -> np.ndarray:
+        return self.frames["time"]
+
+    @property
+    def time_delta(self) -> np.ndarray:
+        return self.frames["time_delta"]
+
+    @property
+    def x(self) -> np.ndarray:
+        return self.frames["x"]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.frames["y"]
+
+    @property
+    def keys(self) -> np.ndarray:
+        return self.frames["keys"]
+
+    def key_presses(self) -> HitEvents:
+        """
+        Frames where any of M1, M2, K1 or K2 goes down that was up in the previous frame.
+        """
+        keys = self.keys & int(PRESS_KEYS)
+        previous_keys = np.empty_like(keys)
+        previous_keys[0:1] = 0
+        previous_keys[1:] = keys[:-1]
+        pressed = np.flatnonzero(keys & ~previous_keys)
+        return HitEvents(time=self.time[pressed],
+                         keys=self.keys[pressed],
+                         x=self.x[pressed],
+                         y=self.y[pressed],
+                         frame_idx=pressed)
+
+    def to_events(self) -> List[ReplayEventOsu]:
+        return [ReplayEventOsu(time_delta=time_delta, x=x, y=y, keys=Key(keys))
+                for time_delta, x, y, keys in zip(self.time_delta.tolist(), self.x.tolist(), self.y.tolist(),
+                                                  self.keys.tolist())]
+
+    def apply_to(self, replay: Replay):
+        """
+        Replace the replay's frames with these, e.g. after editing cursor positions.
+        """
+        replay.replay_data = self.to_events()
+        return replay
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return f"ReplayFrames({len(self)} frames, {self.time[-1] if len(self) else 0}ms)"
@@ -0,0 +1,307 @@
+"""
+Google Sheets fetch layer: one values().batchGet call per spreadsheet, with
+the spreadsheets fetched concurrently.
+
+The Sheets client's httplib2 transport is not thread safe, so concurrent
+fetches take an `http_factory` that returns a fresh authorized Http per call.
+
+Responses can also go through a SheetSnapshotStore, which keeps gzipped
+snapshots on disk so a bracket can be rebuilt offline or while Sheets is
+rate limiting.
+"""
+import datetime
+import gzip
+import hashlib
+import http.client
+import json
+import logging
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import httplib2
+from google.auth.exceptions import TransportError
+from googleapiclient.errors import HttpError
+
+from utils.files import write_atomic
+
+logger = logging.getLogger(__name__)
+
+FORMATTED_VALUE = "FORMATTED_VALUE"
+UNFORMATTED_VALUE = "UNFORMATTED_VALUE"
+DEFAULT_SNAPSHOT_DIR = Path("sheet_snapshots")
+SNAPSHOT_TIME_FORMAT = "%Y%m%dT%H%M%S%fZ"
+
+SheetValues = Dict[Tuple[str, str], List[list]]  # (spreadsheet id, range) -> rows
+
+# Failures of the request itself, worth retrying or answering from a snapshot.
+# TransportError covers the token refresh that runs before the request.
+TRANSPORT_ERRORS = (HttpError, OSError, httplib2.HttpLib2Error, http.client.HTTPException, TransportError)
+
+
+class RangeBatch(NamedTuple):
+    spreadsheet_id: str
+    ranges: Sequence[str]
+    value_render_option: str = FORMATTED_VALUE
+
+
+def batch_get(sheet, batch: RangeBatch, http=None) -> SheetValues:
+    """
+    Fetch every range of `batch` in a single request. Ranges with no values map to an empty list.
+    """
+    request = sheet.values().batchGet(spreadsheetId=batch.spreadsheet_id,
+                                      ranges=list(batch.ranges),
+                                      valueRenderOption=batch.value_render_option)
+    response = request.execute(http=http) if http is not None else request.execute()
+    # Sheets normalises the returned range names, but keeps the request order
+    value_ranges = response.get("valueRanges", [])
+    return {(batch.spreadsheet_id, range_name): value_range.get("values", [])
+            for range_name, value_range in zip(batch.ranges, value_ranges)}
+
+
+def fetch_ranges(sheet, batches: Iterable[RangeBatch], http_factory: Optional[Callable] = None,
+                 max_workers: Optional[int] = None) -> SheetValues:
+    """
+    Run `batch_get` for every batch, concurrently when `http_factory` is given,
+    and merge the results.
+    """
+    batches = list(batches)
+    values = {}
+    if http_factory is None or len(batches) < 2:
+        for batch in batches:
+            values.update(batch_get(sheet, batch, http_factory() if http_factory else None))
+        return values
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(batches)) as executor:
+        for batch_values in executor.map(lambda batch: batch_get(sheet, batch, http_factory()), batches):
+            values.update(batch_values)
+    return values
+
+
+class SheetSnapshotStore:
+    """
+    Gzipped JSON snapshots of batch responses, stored as
+    <directory>/<spreadsheet id>/<ranges digest>/<UTC timestamp>.json.gz.
+    A new snapshot is only written when the values changed. Otherwise the
+    latest one is touched, so its mtime tells when it was last confirmed.
+    """
+
+    def __init__(self, directory=DEFAULT_SNAPSHOT_DIR):
+        self.directory = Path(directory)
+
+    def batch_directory(self, batch: RangeBatch) -> Path:
+        ranges_digest = hashlib.sha1(json.dumps([list(batch.ranges), batch.value_render_option])
+                                     .encode("utf-8")).hexdigest()[:16]
+        return self.directory / batch.spreadsheet_id / ranges_digest
+
+    def latest_path(self, batch: RangeBatch) -> Optional[Path]:
+        snapshots = sorted(self.batch_directory(batch).glob("*.json.gz"))
+        return snapshots[-1] if snapshots else None
+
+    def load(self, batch: RangeBatch, path: Optional[Path] = None) -> SheetValues:
+        path = path or self.latest_path(batch)
+        if path is None:
+            raise FileNotFoundError(f"No snapshot of {batch.spreadsheet_id} {list(batch.ranges)} "
+                                    f"in {self.directory}.")
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        return {(batch.spreadsheet_id, range_name): rows for range_name, rows in snapshot["values"].items()}
+
+    def age(self, batch: RangeBatch) -> Optional[float]:
+        path = self.latest_path(batch)
+        return None if path is None else time.time() - path.stat().st_mtime
+
+    def save(self, batch: RangeBatch, values: SheetValues) -> Path:
+        latest_path = self.latest_path(batch)
+        if latest_path is not None and self.load(batch, latest_path) == values:
+            os.utime(latest_path)
+            return latest_path
+
+        fetched_at = datetime.datetime.now(datetime.timezone.utc)
+        snapshot = {"spreadsheet_id": batch.spreadsheet_id,
+                    "ranges": list(batch.ranges),
+                    "value_render_option": batch.value_render_option,
+                    "fetched_at": fetched_at.isoformat(),
+                    "values": {range_name: values[(batch.spreadsheet_id, range_name)] for range_name in batch.ranges}}
+        path = self.batch_directory(batch) / f"{fetched_at.strftime(SNAPSHOT_TIME_FORMAT)}.json.gz"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # mtime=0 keeps the gzip bytes a function of the values alone
+        write_atomic(path, gzip.compress(json.dumps(snapshot, ensure_ascii=False).encode("utf-8"), mtime=0))
+        return path
+
+
+def fetch_ranges_cached(sheet, batches: Iterable[RangeBatch], store: SheetSnapshotStore, max_age: float = 0,
+                        offline: bool = False, http_factory: Optional[Callable] = None) -> SheetValues:
+    """
+    `fetch_ranges` through `store`. Batches with a snapshot younger than
+    `max_age` seconds are not fetched, and with `offline` nothing is. A batch
+    that fails to fetch with one of TRANSPORT_ERRORS falls back to its latest
+    snapshot if there is one.
+    """
+    values = {}
+    stale_batches = []
+    for batch in batches:
+        age = store.age(batch)
+        if offline or (age is not None and age < max_age):
+            values.update(store.load(batch))
+        else:
+            stale_batches.append(batch)
+
+    def fetch(batch):
+        try:
+            batch_values = batch_get(sheet, batch, http_factory() if http_factory else None)
+        except TRANSPORT_ERRORS as e:
+            if store.latest_path(batch) is None:
+                raise
+            logger.warning(f"Fetching {batch.spreadsheet_id} failed, using its latest snapshot: {e}")
+            return store.load(batch)
+        store.save(batch, batch_values)
+        return batch_values
+
+    if http_factory is None or len(stale_batches) < 2:
+        for batch in stale_batches:
+            values.update(fetch(batch))
+    else:
+        with ThreadPoolExecutor(max_workers=len(stale_batches)) as executor:
+            for batch_values in executor.map(fetch, stale_batches):
+                values.update(batch_values)
+    return values
+
+
+class FakeSheetsService:
+    """
+    Stand-in for `build('sheets', 'v4').spreadsheets()` that answers get and
+    batchGet from canned values, recording every request it executes.
+    """
+
+    def __init__(self, values: SheetValues, error: Optional[Exception] = None):
+        self.canned_values = values
+        self.error = error  # Raised by every execute when set
+        self.requests = []
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range, valueRenderOption=FORMATTED_VALUE):
+        return _FakeRequest(self, "get", spreadsheetId, [range], valueRenderOption)
+
+    def batchGet(self, spreadsheetId, ranges, valueRenderOption=FORMATTED_VALUE):
+        return _FakeRequest(self, "batchGet", spreadsheetId, list(ranges), valueRenderOption)
+
+
+class _FakeRequest:
+
+    def __init__(self, service: FakeSheetsService, method: str, spreadsheet_id: str, ranges: List[str],
+                 value_render_option: str):
+        self.service = service
+        self.method = method
+        self.spreadsheet_id = spreadsheet_id
+        self.ranges = ranges
+        self.value_render_option = value_render_option
+
+    def execute(self, http=None):
+        self.service.requests.append((self.method, self.spreadsheet_id, tuple(self.ranges), self.value_render_option))
+        if self.service.error is not None:
+            raise self.service.error
+        value_ranges = []
+        for range_name in self.ranges:
+            value_range = {"range": range_name, "majorDimension": "ROWS"}
+            rows = self.service.canned_values.get((self.spreadsheet_id, range_name), [])
+            if rows:
+                value_range["values"] = rows
+            value_ranges.append(value_range)
+        if self.method == "get":
+            return value_ranges[0]
+        return {"spreadsheetId": self.spreadsheet_id, "valueRanges": value_ranges}
+
+
+class TestFetchRanges(unittest.TestCase):
+    canned_values = {("stats", "Scores!A:ZZ"): [["1", "2"]],
+                     ("stats", "Teams!A2:B"): [["a", "1"]],
+                     ("pool", "Ro32!AP3:BC"): [["NM", "", "123"]],
+                     ("referee", "Bracket!B2:L"): [[1, 2, 3]]}
+    batches = [RangeBatch("stats", ["Scores!A:ZZ", "Teams!A2:B"]),
+               RangeBatch("pool", ["Ro32!AP3:BC", "Ro16!AP3:BC"]),
+               RangeBatch("referee", ["Bracket!B2:L"], UNFORMATTED_VALUE)]
+
+    def test_one_request_per_spreadsheet(self):
+        service = FakeSheetsService(self.canned_values)
+        values = fetch_ranges(service, self.batches)
+        self.assertEqual(len(service.requests), 3)
+        self.assertTrue(all(method == "batchGet" for method, *_ in service.requests))
+        self.assertIn(("batchGet", "referee", ("Bracket!B2:L",), UNFORMATTED_VALUE), service.requests)
+        self.assertEqual(values[("pool", "Ro32!AP3:BC")], [["NM", "", "123"]])
+        self.assertEqual(values[("pool", "Ro16!AP3:BC")], [])
+        self.assertEqual(len(values), 5)
+
+    def test_concurrent_matches_sequential(self):
+        http_calls = []
+        service = FakeSheetsService(self.canned_values)
+        concurrent_values = fetch_ranges(service, self.batches, http_factory=lambda: http_calls.append(1) or object())
+        self.assertEqual(concurrent_values, fetch_ranges(FakeSheetsService(self.canned_values), self.batches))
+        self.assertEqual(len(http_calls), 3)
+
+
+class TestSheetSnapshotStore(unittest.TestCase):
+    canned_values = TestFetchRanges.canned_values
+    batches = TestFetchRanges.batches
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = SheetSnapshotStore(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_offline_matches_live(self):
+        live_values = fetch_ranges_cached(FakeSheetsService(self.canned_values), self.batches, self.store)
+        self.assertEqual(live_values, fetch_ranges(FakeSheetsService(self.canned_values), self.batches))
+        self.assertEqual(fetch_ranges_cached(None, self.batches, self.store, offline=True), live_values)
+
+    def test_offline_without_snapshot(self):
+        with self.assertRaises(FileNotFoundError):
+            fetch_ranges_cached(None, self.batches, self.store, offline=True)
+
+    def test_conditional_refresh(self):
+        fetch_ranges_cached(FakeSheetsService(self.canned_values), self.batches, self.store)
+        service = FakeSheetsService(self.canned_values)
+        fetch_ranges_cached(service, self.batches, self.store, max_age=60)
+        self.assertEqual(service.requests, [])
+        fetch_ranges_cached(service, self.batches, self.store, max_age=0)
+        self.assertEqual(len(service.requests), 3)
+
+    def test_unchanged_values_keep_one_snapshot(self):
+        for _ in range(2):
+            fetch_ranges_cached(FakeSheetsService(self.canned_values), self.batches, self.store)
+        changed_values = dict(self.canned_values)
+        changed_values[("referee", "Bracket!B2:L")] = [[1, 2, 4]]
+        fetch_ranges_cached(FakeSheetsService(changed_values), self.batches, self.store)
+        self.assertEqual(len(list(self.store.batch_directory(self.batches[0]).iterdir())), 1)
+        self.assertEqual(len(list(self.store.batch_directory(self.batches[2]).iterdir())), 2)
+        self.assertEqual(self.store.load(self.batches[2])[("referee", "Bracket!B2:L")], [[1, 2, 4]])
+
+    def test_transport_error_uses_snapshot(self):
+        live_values = fetch_ranges_cached(FakeSheetsService(self.canned_values), self.batches, self.store)
+        failing_service = FakeSheetsService(self.canned_values, error=OSError("Connection reset"))
+        self.assertEqual(fetch_ranges_cached(failing_service, self.batches, self.store), live_values)
+
+    def test_token_refresh_error_uses_snapshot(self):
+        live_values = fetch_ranges_cached(FakeSheetsService(self.canned_values), self.batches, self.store)
+        for error in (TransportError("Token refresh failed"), http.client.RemoteDisconnected("Remote end closed")):
+            with self.subTest(error=error):
+                failing_service = FakeSheetsService(self.canned_values, error=error)
+                self.assertEqual(fetch_ranges_cached(failing_service, self.batches, self.store), live_values)
+
+    def test_other_errors_propagate(self):
+        fetch_ranges_cached(FakeSheetsService(self.canned_values), self.batches, self.store)
+        failing_service = FakeSheetsService(self.canned_values, error=ValueError("Bad request arguments"))
+        with self.assertRaises(ValueError):
+            fetch_ranges_cached(failing_service, self.batches, self.store)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import math
+import struct
+from array import array
+from functools import lru_cache
+from typing import Iterable, Optional, Sequence, Tuple
+
+EASY = 2 ** 1
+HARD_ROCK = 2 ** 4
+DOUBLE_TIME = 2 ** 6
+HALF_TIME = 2 ** 8
+NIGHTCORE = 2 ** 9
+DIFFICULTY_MODS = EASY | HARD_ROCK | DOUBLE_TIME | HALF_TIME
+
+# The mod combinations osu! caches star ratings for
+COMMON_MODS = (0, DOUBLE_TIME, HALF_TIME, HARD_ROCK, EASY,
+               HARD_ROCK | DOUBLE_TIME, HARD_ROCK | HALF_TIME, EASY | DOUBLE_TIME, EASY | HALF_TIME)
+
+OSU, TAIKO, CATCH, MANIA = range(4)
+
+# Byte 0x08, Int mods, Byte 0x0d, Double star rating
+INT_DOUBLE_PAIR = struct.Struct("<xIxd")
+INT_TYPE = 0x08
+DOUBLE_TYPE = 0x0d
+_UINT = struct.Struct("<I")
+
+
+@lru_cache(maxsize=None)
+def _pairs_struct(num_pairs: int) -> struct.Struct:
+    return struct.Struct("<" + "xIxd" * num_pairs)
+
+
+def difficulty_mods(mods: int) -> int:
+    """
+    Reduce a mod bitmask to the bits that change star rating, as osu! keys them.
+    """
+    if mods & NIGHTCORE:
+        mods |= DOUBLE_TIME
+    return mods & DIFFICULTY_MODS
+
+
+def common_star_rating(common_stars: Sequence[float], mods: int = 0, offset: int = 0) -> Optional[float]:
+    """
+    Cached osu! standard star rating for `mods` out of a run of COMMON_MODS ratings
+    starting at `offset` of `common_stars`, or None for uncached or uncommon mod combinations.
+    """
+    try:
+        mods_idx = COMMON_MODS.index(difficulty_mods(mods))
+    except ValueError:
+        return None
+    stars = common_stars[offset + mods_idx]
+    return None if math.isnan(stars) else stars
+
+
+class StarRatings:
+    """
+    osu!'s cached mod -> star rating tables of a beatmap, one per game mode.
+    Each mode is a run of `mods` with the matching `stars` alongside, in file order.
+    """
+    __slots__ = ("mods", "stars", "mode_offsets")
+
+    def __init__(self, mode_pairs: Sequence[Iterable[Tuple[int, float]]] = ()):
+        self.mods = array('I')
+        self.stars = array('d')
+        mode_offsets = [0]
+        for pairs in mode_pairs:
+            for mods, stars in pairs:
+                self.mods.append(mods)
+                self.stars.append(stars)
+            mode_offsets.append(len(self.mods))
+        self.mode_offsets = tuple(mode_offsets)
+
+    @classmethod
+    def from_buffer(cls, buffer, offset):
+        """
+        Decode the four tables starting at `offset`, returning them with the offset past the last one.
+        """
+        star_ratings = cls()
+        mode_offsets = [0]
+        for _ in range(4):
+            num_pairs, = _UINT.unpack_from(buffer, offset)
+            offset += 4
+            if num_pairs:
+                pairs = _pairs_struct(num_pairs).unpack_from(buffer, offset)
+                star_ratings.mods.extend(pairs[0::2])
+                star_ratings.stars.extend(pairs[1::2])
+                offset += num_pairs * INT_DOUBLE_PAIR.size
+            mode_offsets.append(len(star_ratings.mods))
+        star_ratings.mode_offsets = tuple(mode_offsets)
+        return star_ratings, offset
+
+    def to_bytes(self) -> bytes:
+        """
+        The four tables in osu!.db layout, the inverse of `from_buffer`.
+        """
+        data = bytearray()
+        for begin, end in zip(self.mode_offsets, self.mode_offsets[1:]):
+            num_pairs = end - begin
+            data += _UINT.pack(num_pairs)
+            if num_pairs:
+                pairs = bytearray(_pairs_struct(num_pairs).pack(
+                    *(value for idx in range(begin, end) for value in (self.mods[idx], self.stars[idx]))))
+                # The pad bytes of the layout are the type markers
+                pairs[0::INT_DOUBLE_PAIR.size] = bytes([INT_TYPE]) * num_pairs
+                pairs[5::INT_DOUBLE_PAIR.size] = bytes([DOUBLE_TYPE]) * num_pairs
+                data += pairs
+        return bytes(data)
+
+    def __getstate__(self):
+        return self.mods.tobytes(), self.stars.tobytes(), self.mode_offsets
+
+    def __setstate__(self, state):
+        mods, stars, self.mode_offsets = state
+        self.mods = array('I', mods)
+        self.stars = array('d', stars)
+
+    def get(self, mods: int = 0, mode: int = OSU, default=None):
+        mods = difficulty_mods(mods)
+        for idx in range(self.mode_offsets[mode], self.mode_offsets[mode + 1]):
+            if self.mods[idx] == mods:
+                return self.stars[idx]
+        return default
+
+    def common(self, mode: int = OSU) -> array:
+        """
+        Star ratings for COMMON_MODS in order, NaN where osu! has none cached.
+        """
+        return array('f', (self.get(mods, mode, math.nan) for mods in COMMON_MODS))
+
+    def __eq__(self, other):
+        if not isinstance(other, StarRatings):
+            return NotImplemented
+        return (self.mods, self.stars, self.mode_offsets) == (other.mods, other.stars, other.mode_offsets)
+
+    def __repr__(self):
+        return f"StarRatings(NM={self.get(0)}, DT={self.get(DOUBLE_TIME)}, HR={self.get(HARD_ROCK)})"
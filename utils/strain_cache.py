@@ -0,0 +1,93 @@
+import logging
+import sqlite3
+import time
+from array import array
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+
+from utils.star_ratings import difficulty_mods
+
+logger = logging.getLogger(__name__)
+
+STRAIN_CACHE_SCHEMA_VERSION = 1
+DEFAULT_STRAIN_CACHE_PATH = Path("strain_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class BeatmapStrains(NamedTuple):
+    section_len: float
+    aim: array  # array('d')
+    speed: array  # array('d')
+    clock_rate: float
+    first_object_ms: float  # Unscaled by clock rate, as written in the .osu
+    last_object_ms: float
+
+
+class StrainCache:
+    """
+    (beatmap md5, mods) -> BeatmapStrains, persisted in SQLite so a round's
+    pool maps are only run through the strain calculator once across runs.
+    Mods are reduced to the bits that change difficulty, and the least
+    recently used entries are evicted past `max_entries`.
+    """
+
+    def __init__(self, cache_path=DEFAULT_STRAIN_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(cache_path)
+        try:
+            schema_version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.DatabaseError:
+            logger.warning(f"Discarding unreadable strain cache {cache_path}.")
+            self.connection.close()
+            Path(cache_path).unlink()
+            self.connection = sqlite3.connect(cache_path)
+            schema_version = 0
+
+        if schema_version != STRAIN_CACHE_SCHEMA_VERSION:
+            with self.connection:
+                self.connection.execute("DROP TABLE IF EXISTS strains")
+                self.connection.execute("CREATE TABLE strains ("
+                                        "md5_hash TEXT NOT NULL, mods INTEGER NOT NULL, section_len REAL, "
+                                        "aim BLOB, speed BLOB, clock_rate REAL, "
+                                        "first_object_ms REAL, last_object_ms REAL, last_used REAL, "
+                                        "PRIMARY KEY (md5_hash, mods))")
+                self.connection.execute(f"PRAGMA user_version = {STRAIN_CACHE_SCHEMA_VERSION}")
+
+    def get(self, md5_hash: str, mods: int) -> Optional[BeatmapStrains]:
+        key = (md5_hash, difficulty_mods(mods))
+        row = self.connection.execute("SELECT section_len, aim, speed, clock_rate, first_object_ms, last_object_ms "
+                                      "FROM strains WHERE md5_hash = ? AND mods = ?", key).fetchone()
+        if row is None:
+            return None
+
+        with self.connection:
+            self.connection.execute("UPDATE strains SET last_used = ? WHERE md5_hash = ? AND mods = ?",
+                                    (time.time(), *key))
+        section_len, aim, speed, clock_rate, first_object_ms, last_object_ms = row
+        return BeatmapStrains(section_len, array('d', aim), array('d', speed), clock_rate,
+                              first_object_ms, last_object_ms)
+
+    def put(self, md5_hash: str, mods: int, strains: BeatmapStrains):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO strains VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (md5_hash, difficulty_mods(mods), strains.section_len,
+                                     array('d', strains.aim).tobytes(), array('d', strains.speed).tobytes(),
+                                     strains.clock_rate, strains.first_object_ms, strains.last_object_ms,
+                                     time.time()))
+            self.connection.execute("DELETE FROM strains WHERE rowid NOT IN "
+                                    "(SELECT rowid FROM strains ORDER BY last_used DESC LIMIT ?)",
+                                    (self.max_entries,))
+
+    def get_or_compute(self, md5_hash: str, mods: int, compute: Callable[[], BeatmapStrains]) -> BeatmapStrains:
+        strains = self.get(md5_hash, mods)
+        if strains is None:
+            logger.debug(f"Calculating strains of {md5_hash} with mods {mods}.")
+            strains = compute()
+            self.put(md5_hash, mods, strains)
+        return strains
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM strains").fetchone()[0]
+
+    def close(self):
+        self.connection.close()